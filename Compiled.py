@@ -0,0 +1,395 @@
+"""
+Compiled.py contains the CompiledQnet class, an immutable array-backed snapshot of a Qnet graph.
+
+Node and edge costs are stored as contiguous float64 arrays per cost type, and the graph structure in compressed sparse
+row (CSR) form, so that shortest paths, path costs and connectivity can be computed with NumPy and scipy.sparse.csgraph
+rather than through the dictionaries of the Qnet. Results are given as integer node indices, which can be mapped back
+to Qnodes with to_qnodes and to_path.
+"""
+
+import copy
+import numpy as np
+import scipy.sparse
+from scipy.sparse import csgraph
+import QNET
+
+
+def _frozen(array):
+    array.flags.writeable = False
+    return array
+
+
+class CompiledQnet:
+    def __init__(self, Q):
+        """
+        Compile a Qnet into an immutable, integer-indexed snapshot.
+
+        Usually made with Qnet.compile(). Changes made to Q afterwards are not reflected in the snapshot.
+
+        Parameters
+        ----------
+        Q: Qnet()
+            Qnet graph (or view) to compile
+
+        Attributes
+        ----------
+        G: Qnet()
+            The compiled graph
+        nodes: list
+            Qnodes in the order of their index
+        names: list
+            Names of the Qnodes in the order of their index
+        index: dict
+            Dictionary between Qnodes and their index
+        cost_types: list
+            All cost types of the snapshot, including the additive "add_" costs
+        node_costs: dict [str, array]
+            Dictionary between cost types and an array of the cost of each node
+        edges: array
+            (M, 2) integer array of the endpoints of each edge
+        edge_costs: dict [str, array]
+            Dictionary between cost types and an array of the cost of each edge
+        indptr, indices, edge_ids: array
+            CSR adjacency. The neighbors of node i are indices[indptr[i]:indptr[i+1]], and edge_ids gives the edge of
+            each entry. Every edge appears once in each direction.
+
+        Warnings
+        --------
+        Edges that don't have a cost get the value 1, as in best_path.
+        """
+        self.G = Q
+        self.conversions = Q.conversions
+
+        self.nodes = list(Q.nodes)
+        self.names = [node.name for node in self.nodes]
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        num_nodes = len(self.nodes)
+
+        self.cost_types = []
+        for cost_type in Q.cost_vector:
+            self.cost_types += [cost_type, "add_" + cost_type]
+
+        # Node costs
+        self.node_costs = {}
+        for cost_type in self.cost_types:
+            self.node_costs[cost_type] = _frozen(np.array([node.costs[cost_type] for node in self.nodes],
+                                                          dtype=np.float64))
+
+        # Edges and edge costs
+        edge_data = list(Q.edges(data=True))
+        edges = np.array([(self.index[u], self.index[v]) for u, v, d in edge_data], dtype=np.int64).reshape(-1, 2)
+        self.edges = _frozen(edges)
+        self.edge_costs = {}
+        for cost_type in self.cost_types:
+            self.edge_costs[cost_type] = _frozen(np.array([d.get(cost_type, 1) for u, v, d in edge_data],
+                                                          dtype=np.float64))
+
+        # CSR adjacency with each edge in both directions
+        num_edges = len(edges)
+        rows = np.concatenate([edges[:, 0], edges[:, 1]])
+        cols = np.concatenate([edges[:, 1], edges[:, 0]])
+        edge_ids = np.concatenate([np.arange(num_edges), np.arange(num_edges)])
+        order = np.lexsort((cols, rows))
+        self.indices = _frozen(cols[order])
+        self.edge_ids = _frozen(edge_ids[order])
+        self.indptr = _frozen(np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=num_nodes))]))
+
+        # Row of each CSR entry, for vectorized weights
+        self._rows = _frozen(rows[order])
+
+        # Unmasked weighted adjacency matrices by cost type, made on demand by weights
+        self._weights = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return f"CompiledQnet({len(self.nodes)} nodes, {len(self.edges)} edges)"
+
+    def get_index(self, node):
+        """
+        Get the index of a Qnode or node name. Returns None if there is no such node.
+        """
+        node = self.G.getNode(node)
+        return self.index.get(node)
+
+    def to_qnodes(self, indices):
+        """
+        Map an array of node indices back to Qnodes
+        """
+        return [self.nodes[i] for i in indices]
+
+    def to_path(self, indices):
+        """
+        Map an array of node indices back to a QNET.Path in the compiled graph
+        """
+        return QNET.Path(self.G, self.to_qnodes(indices))
+
+    def edge_id(self, u, v):
+        """
+        Get the edge between the nodes with index u and v. Returns None if they aren't adjacent.
+        """
+        start, stop = self.indptr[u], self.indptr[u + 1]
+        i = start + np.searchsorted(self.indices[start:stop], v)
+        if i < stop and self.indices[i] == v:
+            return int(self.edge_ids[i])
+        return None
+
+    def refresh_edges(self, edges):
+        """
+        Make a new snapshot with the current costs of some edges of the compiled graph.
+
+        The structure of the graph is shared with this snapshot, so this is only valid if no nodes or edges have been
+        added or removed since it was compiled. Used by Qnet.compiled.
+
+        Parameters
+        ----------
+        edges: iterable
+            Edges (u, v) of Qnodes whose costs have changed
+
+        Returns
+        -------
+        CompiledQnet
+        """
+        compiled = copy.copy(self)
+        compiled._weights = {}
+        edges = list(edges)
+        edge_ids = [self.edge_id(self.index[u], self.index[v]) for u, v in edges]
+        assert None not in edge_ids, "Edge does not exist in the compiled graph"
+
+        compiled.edge_costs = {}
+        for cost_type in self.cost_types:
+            edge_cost = self.edge_costs[cost_type].copy()
+            edge_cost[edge_ids] = [self.G.edges[u, v].get(cost_type, 1) for u, v in edges]
+            compiled.edge_costs[cost_type] = _frozen(edge_cost)
+        return compiled
+
+    def weights(self, cost_type, edge_mask=None, node_mask=None):
+        """
+        Get the weighted adjacency matrix for an additive cost type.
+
+        The weight of the edge (u, v) is cost(u)/2 + cost(v)/2 + cost(u, v), as in best_path. The cost of a path is
+        then the sum of its weights plus half of the cost of its head and tail (see path_weight).
+
+        Parameters
+        ----------
+        cost_type: str
+            Additive cost type (i.e. 'add_e')
+        edge_mask: array, optional
+            Boolean array over edges. Edges where it is False are left out.
+        node_mask: array, optional
+            Boolean array over nodes. Edges of nodes where it is False are left out.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+
+        Warnings
+        --------
+        Without masks, the matrix is cached and shared between calls, so it shouldn't be modified.
+        """
+        assert cost_type in self.cost_types, f"Invalid cost type. \"{cost_type}\" not in {self.cost_types}"
+        if edge_mask is None and node_mask is None and cost_type in self._weights:
+            return self._weights[cost_type]
+
+        node_cost = self.node_costs[cost_type]
+        data = node_cost[self._rows] / 2 + node_cost[self.indices] / 2 + self.edge_costs[cost_type][self.edge_ids]
+
+        keep = None
+        if edge_mask is not None:
+            keep = np.asarray(edge_mask, dtype=bool)[self.edge_ids]
+        if node_mask is not None:
+            node_mask = np.asarray(node_mask, dtype=bool)
+            node_keep = node_mask[self._rows] & node_mask[self.indices]
+            keep = node_keep if keep is None else keep & node_keep
+
+        num_nodes = len(self.nodes)
+        if keep is None:
+            graph = scipy.sparse.csr_matrix((data, self.indices, self.indptr), shape=(num_nodes, num_nodes))
+            self._weights[cost_type] = graph
+            return graph
+        return scipy.sparse.csr_matrix((data[keep], (self._rows[keep], self.indices[keep])),
+                                       shape=(num_nodes, num_nodes))
+
+    def path_weight(self, indices, cost_type):
+        """
+        Get the total additive cost of a path of node indices, including all of its node costs
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        edge_ids = [self.edge_id(indices[i], indices[i + 1]) for i in range(len(indices) - 1)]
+        assert None not in edge_ids, "Path does not exist in the compiled graph"
+        return self.node_costs[cost_type][indices].sum() + self.edge_costs[cost_type][edge_ids].sum()
+
+    def path_cost(self, indices):
+        """
+        Get the cost vector of a path of node indices. This gives the same costs as QNET.Path.cost_vector.
+        """
+        cost_vector = {}
+        for cost_type in self.conversions:
+            add_cost = self.path_weight(indices, "add_" + cost_type)
+            cost_vector[cost_type] = self.conversions[cost_type][1](add_cost)
+            cost_vector["add_" + cost_type] = add_cost
+        return cost_vector
+
+    def shortest_path(self, source, target, cost_type, edge_mask=None, node_mask=None):
+        """
+        Find the path between two nodes that optimizes a cost type.
+
+        Parameters
+        ----------
+        source: int
+            Index of the source node
+        target: int
+            Index of the target node
+        cost_type: str
+            Any valid cost type from the cost vector (i.e. 'e')
+        edge_mask, node_mask: array, optional
+            Boolean masks of edges and nodes to leave out. (See weights)
+
+        Returns
+        -------
+        (array, float)
+            Node indices of the optimal path and its additive cost (including the head and tail costs). If no path
+            exists, returns (None, inf)
+        """
+        assert cost_type in self.conversions, \
+            f"Invalid cost type. \"{cost_type}\" not in {str([key for key in self.conversions])}"
+        cost_type = "add_" + cost_type
+
+        graph = self.weights(cost_type, edge_mask, node_mask)
+        dist, pred = csgraph.dijkstra(graph, directed=True, indices=source, return_predecessors=True)
+        if not np.isfinite(dist[target]):
+            return None, np.inf
+
+        path = [target]
+        while path[-1] != source:
+            path.append(pred[path[-1]])
+        path = np.array(path[::-1], dtype=np.int64)
+
+        # Compensate shortest path cost with 1/2 head cost and 1/2 tail cost
+        node_cost = self.node_costs[cost_type]
+        cost = dist[target] + node_cost[source] / 2 + node_cost[target] / 2
+        return path, cost
+
+
+class PathIncidence:
+    def __init__(self, C, paths):
+        """
+        Sparse path incidence matrix, for evaluating the costs of many paths over many snapshots at once.
+
+        Each row is a path and each column an edge or node of the compiled graph, so that the additive costs of all
+        paths are the product of the matrix with the stacked cost arrays of the edges and nodes (see evaluate).
+
+        Parameters
+        ----------
+        C: CompiledQnet
+            Compiled graph of the paths
+        paths: list
+            Paths as QNET.Path objects, lists of Qnodes (or names), or arrays of node indices
+
+        Attributes
+        ----------
+        C: CompiledQnet
+            Compiled graph of the paths
+        paths: list
+            Node indices of each path
+        cost_types: list
+            Cost types along the last axis of the evaluated costs
+        matrix: scipy.sparse.csr_matrix
+            (n_paths, M + N) incidence matrix. Column i < M is edge i, and column M + j is node j.
+        """
+        self.C = C
+        self.cost_types = list(C.conversions)
+
+        self.paths = []
+        for path in paths:
+            if isinstance(path, QNET.Path):
+                path = path.node_array
+            if len(path) > 0 and not isinstance(path[0], (int, np.integer)):
+                path = [C.get_index(node) for node in path]
+                assert None not in path, "Path does not exist in the compiled graph"
+            self.paths.append(np.asarray(path, dtype=np.int64))
+
+        num_edges = len(C.edges)
+        rows, cols = [], []
+        for row, path in enumerate(self.paths):
+            edge_ids = [C.edge_id(path[i], path[i + 1]) for i in range(len(path) - 1)]
+            assert None not in edge_ids, "Path does not exist in the compiled graph"
+            cols += edge_ids + list(path + num_edges)
+            rows += [row] * (len(edge_ids) + len(path))
+
+        # The Qnodes of each column, so that the columns can be found in snapshots with a different structure
+        self._columns = [(C.nodes[u], C.nodes[v]) for u, v in C.edges] + C.nodes
+
+        shape = (len(self.paths), num_edges + len(C))
+        self.matrix = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+        self.matrix.sum_duplicates()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def cost_array(self, C=None):
+        """
+        Get the additive costs of the columns of the incidence matrix in a snapshot of the graph.
+
+        Parameters
+        ----------
+        C: CompiledQnet, optional
+            Snapshot of the graph (i.e. Q.compiled() after an update). Edges and nodes that aren't in C get an
+            infinite cost, so paths through them come out as broken. (The default is None, which uses self.C)
+
+        Returns
+        -------
+        array
+            (M + N, n_costs) array of additive costs
+        """
+        if C is None:
+            C = self.C
+        add_types = ["add_" + cost_type for cost_type in self.cost_types]
+
+        # Same structure as the incidence matrix, as in a snapshot made by Qnet.compiled after an update
+        if C.edges is self.C.edges or (C.nodes == self.C.nodes and np.array_equal(C.edges, self.C.edges)):
+            return np.stack([np.concatenate([C.edge_costs[cost_type], C.node_costs[cost_type]])
+                             for cost_type in add_types], axis=1)
+
+        # Otherwise look up each column by its Qnodes
+        num_edges = len(self.C.edges)
+        costs = np.full((len(self._columns), len(add_types)), np.inf)
+        for col, item in enumerate(self._columns):
+            if col < num_edges:
+                u, v = C.index.get(item[0]), C.index.get(item[1])
+                edge = None if u is None or v is None else C.edge_id(u, v)
+                if edge is not None:
+                    costs[col] = [C.edge_costs[cost_type][edge] for cost_type in add_types]
+            else:
+                node = C.index.get(item)
+                if node is not None:
+                    costs[col] = [C.node_costs[cost_type][node] for cost_type in add_types]
+        return costs
+
+    def evaluate(self, cost_arrays, additive=False):
+        """
+        Get the costs of every path in every snapshot with one sparse matrix product.
+
+        Parameters
+        ----------
+        cost_arrays: list
+            Cost arrays of each snapshot (see cost_array), or CompiledQnet snapshots
+        additive: bool, optional
+            Return the additive costs instead of converting them back. (The default is False)
+
+        Returns
+        -------
+        array
+            (n_paths, n_steps, n_costs) array of path costs, with costs in the order of self.cost_types
+        """
+        cost_arrays = [self.cost_array(X) if isinstance(X, CompiledQnet) else np.asarray(X, dtype=np.float64)
+                       for X in cost_arrays]
+        num_costs = len(self.cost_types)
+        X = np.stack(cost_arrays, axis=1).reshape(self.matrix.shape[1], -1)
+        costs = np.asarray(self.matrix @ X).reshape(len(self.paths), len(cost_arrays), num_costs)
+
+        if not additive:
+            for i, cost_type in enumerate(self.cost_types):
+                costs[..., i] = self.C.conversions[cost_type][1](costs[..., i])
+        return costs
@@ -0,0 +1,132 @@
+"""
+Connectivity.py contains functions for checking whether pairs of nodes are connected. All pairs of a graph, and all
+percolated instances of a graph given by survival masks, are checked together with one connected components pass over
+an integer-indexed edge list.
+"""
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse import csgraph
+
+
+def edge_index(Q):
+    """
+    Get an integer-indexed edge list for a graph
+
+    Parameters
+    ----------
+    Q: Qnet()
+        Qnet graph (or view)
+
+    Returns
+    -------
+    (list, dict, array)
+        List of Qnodes in the order of Q.nodes, dictionary between Qnodes and their index, and an (M, 2) integer
+        array of edges
+    """
+    nodes = list(Q.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = np.array([(index[u], index[v]) for u, v in Q.edges], dtype=np.int64).reshape(-1, 2)
+    return nodes, index, edges
+
+
+def component_labels(num_nodes, edges, masks=None):
+    """
+    Label the connected components of a graph, or of many percolated instances of a graph at once.
+
+    The instances given by masks are stacked into one block diagonal graph, so a single call to
+    scipy.sparse.csgraph.connected_components labels all of them.
+
+    Parameters
+    ----------
+    num_nodes: int
+        Number of nodes in the graph
+    edges: array
+        (M, 2) integer array of edges
+    masks: array, optional
+        Boolean survival masks of shape (num_nodes,) or (B, num_nodes). True where the node survives.
+        (The default is None, in which case all nodes survive)
+
+    Returns
+    -------
+    array
+        Component labels of shape (num_nodes,) or (B, num_nodes). Nodes in the same component of the same instance
+        share a label. Removed nodes are labeled -1.
+    """
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    if masks is None:
+        masks = np.ones(num_nodes, dtype=bool)
+    masks = np.asarray(masks, dtype=bool)
+    single = masks.ndim == 1
+    masks = np.atleast_2d(masks)
+    num_masks = masks.shape[0]
+
+    # Keep the edges whose endpoints both survive, offset into the block of their instance
+    alive = masks[:, edges[:, 0]] & masks[:, edges[:, 1]]
+    block, edge_ids = np.nonzero(alive)
+    offset = block * num_nodes
+    rows = edges[edge_ids, 0] + offset
+    cols = edges[edge_ids, 1] + offset
+
+    size = num_masks * num_nodes
+    graph = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(size, size))
+    num_components, labels = csgraph.connected_components(graph, directed=False)
+
+    labels = labels.reshape(num_masks, num_nodes)
+    labels[~masks] = -1
+    if single:
+        return labels[0]
+    return labels
+
+
+def connected_pairs(num_nodes, edges, heads, tails, masks=None):
+    """
+    Check whether pairs of nodes are connected, for one or many percolated instances of a graph.
+
+    Parameters
+    ----------
+    num_nodes: int
+        Number of nodes in the graph
+    edges: array
+        (M, 2) integer array of edges
+    heads: array
+        Integer indices of the head of each pair
+    tails: array
+        Integer indices of the tail of each pair
+    masks: array, optional
+        Boolean survival masks of shape (num_nodes,) or (B, num_nodes)
+
+    Returns
+    -------
+    array
+        Boolean array of shape (P,) or (B, P). True where the head and tail of a pair are connected.
+    """
+    labels = component_labels(num_nodes, edges, masks)
+    heads = np.asarray(heads, dtype=np.int64)
+    tails = np.asarray(tails, dtype=np.int64)
+    head_labels = labels[..., heads]
+    return (head_labels == labels[..., tails]) & (head_labels != -1)
+
+
+def pairs_connected(Q, heads, tails):
+    """
+    Check whether pairs of Qnodes in a graph are connected
+
+    Parameters
+    ----------
+    Q: Qnet()
+        Qnet graph (or view)
+    heads: list
+        Qnodes (or names) of the head of each pair
+    tails: list
+        Qnodes (or names) of the tail of each pair
+
+    Returns
+    -------
+    array
+        Boolean array. True where the head and tail of a pair are connected.
+    """
+    nodes, index, edges = edge_index(Q)
+    heads = [index[Q.getNode(head)] for head in heads]
+    tails = [index[Q.getNode(tail)] for tail in tails]
+    return connected_pairs(len(nodes), edges, heads, tails)
@@ -6,6 +6,11 @@ import networkx as nx
 import QNET
 import numpy as np
 import copy
+import concurrent.futures
+import heapq
+import weakref
+import scipy.sparse
+from scipy.sparse import csgraph
 
 def remove_prefix(s, prefix):
     """
@@ -84,6 +89,107 @@ def from_add_f(x):
     return (1 + np.exp(-1 * x)) / 2
 
 
+class CostDict(dict):
+    """
+    Dictionary of the costs of a Qnode or channel that reports the changes made to it to the Qnets that hold it.
+
+    Qnets cache their compiled snapshot and paths cache their cost vectors until the Qnet changes (see Qnet.version).
+    Changes made by hand to a cost dictionary, such as node.costs['e'] = 0.9, Q[u][v]['e'] = 0.9 or
+    nx.set_edge_attributes, mark the Qnets that hold it as changed, so these caches are rebuilt as if Qnet.touch had
+    been called.
+
+    Node costs (Qnode.costs) and the edge dictionaries of a Qnet are CostDicts. The Qnets that hold a CostDict are
+    kept as weak references, and copies of a CostDict (including deep copies and unpickled ones) aren't held by any
+    Qnet until they are added to one.
+
+    Examples
+    --------
+    Hand edits change the best path, and copying another Qnet leaves the caches of Q alone
+    >>> Q = QNET.Qnet()
+    >>> for name in 'ABCD':
+    ...     Q.add_qnode(name=name, qnode_type='Ground')
+    >>> Q.add_qchan(edge=['A', 'B'], e=0.9)
+    >>> Q.add_qchan(edge=['B', 'D'], e=0.9)
+    >>> Q.add_qchan(edge=['A', 'C'], e=0.8)
+    >>> Q.add_qchan(edge=['C', 'D'], e=0.8)
+    >>> best_path(Q, 'A', 'D', 'e').node_array
+    deque([A, B, D])
+    >>> Q[Q.getNode('A')][Q.getNode('B')]['add_e'] = 5.0
+    >>> best_path(Q, 'A', 'D', 'e').node_array
+    deque([A, C, D])
+    >>> Q.getNode('C').costs['add_e'] = 10.0
+    >>> best_path(Q, 'A', 'D', 'e').node_array
+    deque([A, B, D])
+    >>> version = Q.version
+    >>> other = copy.deepcopy(Q)
+    >>> other.getNode('C').costs['add_e'] = 0.0
+    >>> Q.version == version
+    True
+    """
+    __slots__ = ('_owners',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Weak references to the Qnets that hold the dictionary
+        self._owners = ()
+
+    def __reduce__(self):
+        # Copies are rebuilt from a plain dictionary, so they don't report the rebuild and aren't held by any Qnet
+        return CostDict, (dict(self),)
+
+    def _own(self, G):
+        # Report the changes of the dictionary to G as well
+        owners = tuple(ref for ref in self._owners if ref() is not None and ref() is not G)
+        self._owners = owners + (weakref.ref(G),)
+
+    def _disown(self, G):
+        self._owners = tuple(ref for ref in self._owners if ref() is not None and ref() is not G)
+
+    def _edited(self):
+        for ref in self._owners:
+            G = ref()
+            if G is not None:
+                G.touch()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._edited()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._edited()
+
+    def __ior__(self, other):
+        result = super().__ior__(other)
+        self._edited()
+        return result
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._edited()
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        value = super().setdefault(key, default)
+        self._edited()
+        return value
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._edited()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._edited()
+        return item
+
+    def clear(self):
+        super().clear()
+        self._edited()
+
+
 def make_cost_vector(Q, **kwargs):
     """
     Creates a cost vector (that includes additive costs) for an object in the graph Q.
@@ -140,6 +246,38 @@ def make_cost_vector(Q, **kwargs):
 
     return cost_vector
 
+def update_cost_vector(Q, cost_vector, **kwargs):
+    """
+    Updates an existing cost vector in place with new costs and their additive forms.
+
+    Unlike make_cost_vector, no new dictionary is made and the costs are not checked against Q.cost_ranges, so this is
+    intended for callers that already know their costs are valid (i.e. Satellite.airCost).
+
+    The change is not reported as an edit by hand (see CostDict), so that Qnet.update can refresh only the edges it
+    changed. Callers must call Qnet.touch afterwards, with the edge if the cost vector is that of an edge.
+
+    Parameters
+    ----------
+    Q: Qnet()
+        The graph with reference to the cost conversions
+    cost_vector: dict
+        The cost vector to be updated
+    kwargs
+        Keyword arguments for the updated costs
+
+    Returns
+    -------
+    dict
+        The updated cost vector
+    """
+    conversions = Q.conversions
+    for name, value in kwargs.items():
+        if name in conversions:
+            dict.__setitem__(cost_vector, name, value)
+            dict.__setitem__(cost_vector, "add_" + name, conversions[name][0](value))
+    return cost_vector
+
+
 def make_memory_vector(Q, **kwargs):
     """
     Creates a dictionary of memory costs for a node with quantum memory.
@@ -214,46 +352,39 @@ def convert_cost_vector(Q, cost_vector=None, add_cost_vector=None):
     return new_cv
 
 
+def _compiled_best_path(Q, source, target, cost_type):
+    # Shortest path on the cached compiled snapshot of Q, raising the same errors as nx.dijkstra_path
+    conversions = Q.conversions
+    assert cost_type in conversions, f"Invalid cost type. \"{cost_type}\" not in {str([key for key in conversions])}"
+
+    C = Q.compiled()
+    i = C.get_index(source)
+    j = C.get_index(target)
+    if i is None or j is None:
+        raise nx.NodeNotFound(f"Source {source} or target {target} is not in Q")
+
+    path, cost = C.shortest_path(i, j, cost_type)
+    if path is None:
+        raise nx.NetworkXNoPath(f"No path between {source} and {target}.")
+    return C, path, cost
+
+
 def best_path(Q, source, target, cost_type):
     """
     Given a source node, target node, and a cost type, this function returns the path that optimises this cost.
+
+    The edge weights node_u/2 + node_v/2 + edge are precomputed for each cost type on the compiled snapshot of Q
+    (see Qnet.compiled), which is only rebuilt when a cost of Q changes.
+
     :param Q: Qnet graph
     :param source: Source node
     :param target: Target node
     :param cost_type: Any valid cost type from the cost vector
     :return: string
     """
-    def get_weight_function(costType):
-        """
-        Given a costType, returns a corresponding weight_function
-        for use in nx.shortest_path_length
-
-        :param string costType: cost type in ['e', 'p']
-        :return: weight function
-        """
-
-        def weight(u, v, d):
-            node_u_wt = u.costs[costType]
-            node_v_wt = v.costs[costType]
-            # Attempts to get edge weight, returns 1 if not found
-            edge_wt = d.get(costType, 1)
-            return node_u_wt / 2 + node_v_wt / 2 + edge_wt
-            # Note that shortest path cost will need to be compensated with 1/2 head and 1/2 tail cost
-
-        return weight
-
-    source = Q.getNode(source)
-    target = Q.getNode(target)
-
-    conversions = Q.conversions
-    assert cost_type in conversions, f"Invalid cost type. \"{cost_type}\" not in {str([key for key in conversions])}"
-    # Change cost type to additive
-    cost_type = "add_" + cost_type
-
-    weight = get_weight_function(cost_type)
-    path = nx.dijkstra_path(Q, source, target, weight)
+    C, path, cost = _compiled_best_path(Q, source, target, cost_type)
     # Convert array of nodes to Path class
-    path = QNET.Path(Q, path)
+    path = QNET.Path(Q, C.to_qnodes(path))
     return path
 
 
@@ -268,42 +399,839 @@ def best_path_cost(Q, source, target, cost_type):
     :param str costType: Any of {'e', 'p', 'de', 'dp'}
     :return: float length of shortest path in units of costType
     """
+    # Best cost in terms of additive cost, compensated with 1/2 head cost and 1/2 tail cost
+    C, path, cost = _compiled_best_path(Q, source, target, cost_type)
+
+    # Convert multiplicative costs back to additive costs
+    back_convert = Q.conversions[cost_type][1]
+    cost = back_convert(cost)
+
+    return cost
+
+
+def k_best_paths(Q, source, target, cost_type, k=None, cutoff=None):
+    """
+    Generate the simple paths between two nodes in order of increasing cost, without enumerating all of them.
+
+    Paths are found lazily with Yen's algorithm (nx.shortest_simple_paths) on the precomputed additive weights of
+    the compiled snapshot of Q, so only as many shortest path searches are run as paths are taken.
+
+    Parameters
+    ----------
+    Q: Qnet()
+        Qnet graph
+    source: Union[str, Qnode]
+        Source node
+    target: Union[str, Qnode]
+        Target node
+    cost_type: str
+        Any valid cost type from the cost vector (i.e. 'e') to rank the paths by
+    k: int, optional
+        Maximum number of paths to generate. (The default is None, which has no limit)
+    cutoff: float, optional
+        Worst acceptable value of the cost. i.e. 0.5 stops once the efficiency of the next path is below 0.5.
+        (The default is None, which has no limit)
+
+    Yields
+    ------
+    Path
+        Paths in order from best to worst cost
+    """
+    conversions = Q.conversions
+    assert cost_type in conversions, f"Invalid cost type. \"{cost_type}\" not in {str([key for key in conversions])}"
+    add_cost_type = "add_" + cost_type
+    if cutoff is not None:
+        cutoff = conversions[cost_type][0](cutoff)
+
+    C = Q.compiled()
+    i = C.get_index(source)
+    j = C.get_index(target)
+    if i is None or j is None:
+        raise nx.NodeNotFound(f"Source {source} or target {target} is not in Q")
+
+    # Integer graph with the combined node and edge weights stored on the edges
+    node_cost = C.node_costs[add_cost_type]
+    weights = node_cost[C.edges[:, 0]] / 2 + node_cost[C.edges[:, 1]] / 2 + C.edge_costs[add_cost_type]
+    H = nx.Graph()
+    H.add_nodes_from(range(len(C)))
+    H.add_weighted_edges_from(zip(C.edges[:, 0].tolist(), C.edges[:, 1].tolist(), weights.tolist()))
+
+    if k is not None and k < 1:
+        return
+    count = 0
+    try:
+        for path in nx.shortest_simple_paths(H, i, j, weight='weight'):
+            if cutoff is not None and C.path_weight(path, add_cost_type) > cutoff:
+                break
+            yield QNET.Path(Q, C.to_qnodes(path))
+            count += 1
+            if k is not None and count >= k:
+                break
+    except nx.NetworkXNoPath:
+        return
+
+
+class ShortestPathTree:
+    def __init__(self, Q, source, cost_type, subscribe=False):
+        """
+        Shortest path tree from a source node that can be brought up to date as Q changes.
+
+        Changes are applied locally: nodes below tree edges whose weight increased are cut off and reconnected from
+        the rest of the tree, and a Dijkstra search is run only from the nodes whose distance can change (as in the
+        dynamic shortest path algorithm of Ramalingam and Reps).
+
+        By default, update compares the weights of the compiled snapshot of Q with those of the tree to find the
+        changed edges. With subscribe=True, the tree is instead notified of each change to Q (see Qnet.subscribe),
+        and is brought up to date whenever it is queried. Edge costs changed by Qnet.update, channels added or
+        removed by add_qchan or Qnet.update, and Qnodes removed by remove_qnode are then applied without looking at
+        the rest of the graph. Any change that adds new nodes or edges, changes the cost of a Qnode, or edits a cost
+        dictionary by hand (See CostDict), makes the tree be recomputed from scratch.
+
+        Parameters
+        ----------
+        Q: Qnet()
+            Qnet graph
+        source: Union[str, Qnode]
+            Source node
+        cost_type: str
+            Any valid cost type from the cost vector (i.e. 'e')
+        subscribe: bool, optional
+            If True, subscribe to the changes of Q. (The default is False)
+
+        Attributes
+        ----------
+        C: CompiledQnet
+            Compiled snapshot of Q that the tree is indexed by. Qnodes removed since are left in C without edges.
+        dist: array
+            Additive distance of each node from the source, without the head and tail compensation. inf if unreachable
+        pred: array
+            Predecessor of each node in the tree. -9999 for the source and unreachable nodes, as in csgraph.dijkstra
+
+        Examples
+        --------
+        A subscribed tree agrees with a full search after random cost updates, channels added with add_qchan and
+        Qnodes removed with remove_qnode
+        >>> import random
+        >>> random.seed(1)
+        >>> Q = QNET.Qnet()
+        >>> for i in range(20):
+        ...     Q.add_qnode(name=str(i), qnode_type='Ground')
+        >>> for i in range(40):
+        ...     u, v = random.sample(range(1, 20), 2)
+        ...     Q.add_qchan(edge=[str(u), str(v)], e=random.uniform(0.5, 1), f=random.uniform(0.6, 1))
+        >>> Q.add_qchan(edge=['0', '1'], e=0.9, f=0.9)
+        >>> tree = ShortestPathTree(Q, '0', 'e', subscribe=True)
+        >>> consistent = []
+        >>> for step in range(30):
+        ...     edges = list(Q.edges(data=True))
+        ...     u, v, costs = edges[random.randrange(len(edges))]
+        ...     if step % 3 == 0:
+        ...         costs = QNET.update_cost_vector(Q, costs, e=random.uniform(0.1, 1))
+        ...         Q.touch((u, v))
+        ...     elif step % 3 == 1:
+        ...         a, b = random.sample(range(1, 20), 2)
+        ...         Q.add_qchan(edge=[str(a), str(b)], e=random.uniform(0.5, 1), f=random.uniform(0.6, 1))
+        ...     elif len(Q) > 5:
+        ...         Q.remove_qnode(random.choice([node for node in Q.nodes if node.name != '0']))
+        ...     for target in Q.nodes:
+        ...         try:
+        ...             expected = best_path_cost(Q, '0', target, 'e')
+        ...         except nx.NetworkXNoPath:
+        ...             expected = 0
+        ...         consistent.append(bool(np.isclose(tree.cost(target), expected)))
+        ...     consistent.append(tree.verify())
+        >>> all(consistent)
+        True
+        """
+        conversions = Q.conversions
+        assert cost_type in conversions, \
+            f"Invalid cost type. \"{cost_type}\" not in {str([key for key in conversions])}"
+        self.G = Q
+        self.cost_type = cost_type
+        self.source = Q.getNode(source)
+        self.C = None
+        self.dist = None
+        self.pred = None
+        self._weights = None
+        self._removed = None
+        self._subscribed = False
+        self._pending = []
+        self._reset = False
+        self._rebuild()
+        if subscribe:
+            self.subscribe()
+
+    def subscribe(self):
+        """
+        Subscribe to the changes of Q, so that the tree is kept up to date with it
+        """
+        if not self._subscribed:
+            self.update()
+            self.G.subscribe(self._notify)
+            self._subscribed = True
+
+    def unsubscribe(self):
+        """
+        Stop following the changes of Q
+        """
+        if self._subscribed:
+            self.G.unsubscribe(self._notify)
+            self._subscribed = False
+            self._pending = []
+            self._reset = False
+
+    def _notify(self, change, items):
+        # Listener for the changes of Q. Changes are applied together on the next update.
+        if change is None:
+            self._reset = True
+            self._pending = []
+        elif not self._reset:
+            self._pending.append((change, list(items)))
+
+    def _rebuild(self):
+        # Compute the tree from scratch on the compiled snapshot of Q
+        C = self.G.compiled()
+        s = C.get_index(self.source)
+        if s is None:
+            raise nx.NodeNotFound(f"Source {self.source} is not in Q")
+        graph = C.weights("add_" + self.cost_type)
+        self.dist, self.pred = csgraph.dijkstra(graph, directed=True, indices=s, return_predecessors=True)
+        self.C = C
+        self._weights = graph.data.copy()
+        self._removed = np.zeros(len(C), dtype=bool)
+        self._pending = []
+        self._reset = False
+        return len(C)
+
+    def _structure_changed(self, C):
+        # Whether C has different nodes or edges to the compiled graph of the tree
+        if C.edges is self.C.edges:
+            return False
+        return C.nodes != self.C.nodes or not np.array_equal(C.edges, self.C.edges)
+
+    def _entry(self, i, j):
+        # CSR entry of the edge from node i to node j of C, or None if there is no such edge
+        start, stop = self.C.indptr[i], self.C.indptr[i + 1]
+        k = start + np.searchsorted(self.C.indices[start:stop], j)
+        if k < stop and self.C.indices[k] == j:
+            return int(k)
+        return None
+
+    def update(self):
+        """
+        Bring the tree up to date with Q
+
+        Returns
+        -------
+        int
+            Number of nodes whose distance or predecessor changed
+        """
+        if self._subscribed:
+            if self._reset:
+                return self._rebuild()
+            if len(self._pending) == 0:
+                return 0
+            weights = self._pending_weights()
+            if weights is None:
+                return self._rebuild()
+            entries, new = weights
+        else:
+            C = self.G.compiled()
+            if self._structure_changed(C):
+                return self._rebuild()
+            self.C = C
+            new = C.weights("add_" + self.cost_type).data
+            entries = np.flatnonzero(new != self._weights)
+            new = new[entries]
 
-    def get_weight_function(costType):
+        changed = entries[new != self._weights[entries]]
+        increased = entries[new > self._weights[entries]]
+        self._weights[entries] = new
+        if len(changed) == 0:
+            return 0
+        return self._repair(changed, increased)
+
+    def _pending_weights(self):
+        # New weights of the CSR entries changed by the pending changes of Q, as (entries, weights). Returns None if
+        # the changes can't be applied to the compiled graph of the tree.
+        add_cost_type = "add_" + self.cost_type
+        C = self.C
+        new = {}
+        pending, self._pending = self._pending, []
+        for change, items in pending:
+            if change == 'remove_nodes' or change == 'add_nodes':
+                for node in items:
+                    i = C.index.get(node)
+                    if i is None:
+                        if change == 'add_nodes':
+                            return None
+                        continue
+                    if i == C.index[self.source] and change == 'remove_nodes':
+                        return None
+                    self._removed[i] = change == 'remove_nodes'
+                    # Edges of a removed node are cut. Edges of an added node come with add_edges.
+                    if change == 'remove_nodes':
+                        for k in range(C.indptr[i], C.indptr[i + 1]):
+                            new[k] = np.inf
+                            new[self._entry(C.indices[k], i)] = np.inf
+            else:
+                for u, v in items:
+                    i, j = C.index.get(u), C.index.get(v)
+                    k = None if i is None or j is None else self._entry(i, j)
+                    if k is None:
+                        if change == 'remove_edges':
+                            continue
+                        return None
+                    edge_data = self.G.get_edge_data(u, v)
+                    if edge_data is None or self._removed[i] or self._removed[j]:
+                        weight = np.inf
+                    else:
+                        weight = u.costs[add_cost_type] / 2 + v.costs[add_cost_type] / 2 + \
+                                 edge_data.get(add_cost_type, 1)
+                    new[k] = weight
+                    new[self._entry(j, i)] = weight
+
+        entries = np.fromiter(new.keys(), dtype=np.int64, count=len(new))
+        weights = np.fromiter(new.values(), dtype=np.float64, count=len(new))
+        return entries, weights
+
+    def _repair(self, changed, increased):
+        # Repair the tree after the weights of some CSR entries changed. increased are those whose weight increased.
+        C = self.C
+        weights = self._weights
+        rows = C._rows
+        cols = C.indices
+        dist = self.dist
+        pred = self.pred
+        old_dist = dist.copy()
+        old_pred = pred.copy()
+
+        # Cut off the subtrees below tree edges whose weight increased. Their distances are no longer valid.
+        cut = increased[pred[cols[increased]] == rows[increased]]
+        affected = np.zeros(len(C), dtype=bool)
+        if len(cut) > 0:
+            # Children of each node in the tree, in CSR form
+            kids = np.flatnonzero(pred >= 0)
+            kids = kids[np.argsort(pred[kids], kind='stable')]
+            kid_ptr = np.concatenate([[0], np.cumsum(np.bincount(pred[pred >= 0], minlength=len(C)))])
+            stack = list(set(cols[cut].tolist()))
+            while len(stack) > 0:
+                v = stack.pop()
+                if affected[v]:
+                    continue
+                affected[v] = True
+                stack.extend(kids[kid_ptr[v]:kid_ptr[v + 1]].tolist())
+            dist[affected] = np.inf
+            pred[affected] = -9999
+
+        # Reconnect the cut off nodes from the rest of the tree, and take any shortcuts through decreased edges
+        seeds = np.flatnonzero(affected[cols])
+        seeds = np.concatenate([seeds[~affected[rows[seeds]]], changed])
+        candidate = dist[rows[seeds]] + weights[seeds]
+        better = candidate < dist[cols[seeds]]
+        seeds, candidate = seeds[better], candidate[better]
+        heap = []
+        for entry, d in zip(seeds.tolist(), candidate.tolist()):
+            v = cols[entry]
+            if d < dist[v]:
+                dist[v] = d
+                pred[v] = rows[entry]
+                heap.append((d, v))
+        heapq.heapify(heap)
+
+        # Dijkstra search from the nodes whose distance can change
+        indptr = C.indptr
+        while len(heap) > 0:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for entry in range(indptr[u], indptr[u + 1]):
+                v = cols[entry]
+                new_d = d + weights[entry]
+                if new_d < dist[v]:
+                    dist[v] = new_d
+                    pred[v] = u
+                    heapq.heappush(heap, (new_d, v))
+
+        return int(np.count_nonzero((dist != old_dist) | (pred != old_pred)))
+
+    def _target_index(self, target):
+        # Index of a target node in the tree, bringing a subscribed tree up to date first
+        if self._subscribed:
+            self.update()
+        t = self.C.get_index(target)
+        if t is None or self._removed[t]:
+            raise nx.NodeNotFound(f"Target {target} is not in Q")
+        return t
+
+    def path(self, target):
+        """
+        Get the node indices of the best path to a target, or None if it is unreachable
+        """
+        t = self._target_index(target)
+        if not np.isfinite(self.dist[t]):
+            return None
+        path = [t]
+        while self.pred[path[-1]] >= 0:
+            path.append(self.pred[path[-1]])
+        return np.array(path[::-1], dtype=np.int64)
+
+    def cost(self, target):
+        """
+        Get the cost of the best path to a target
         """
-        Given a costType, returns a corresponding weight_function
-        for use in nx.shortest_path_length
+        t = self._target_index(target)
+        # Compensate shortest path cost with 1/2 head cost and 1/2 tail cost
+        node_cost = self.C.node_costs["add_" + self.cost_type]
+        cost = self.dist[t] + node_cost[self.C.index[self.source]] / 2 + node_cost[t] / 2
+        return self.G.conversions[self.cost_type][1](cost)
 
-        :param string costType: cost type in ['e', 'p']
-        :return: weight function
+    def verify(self):
         """
+        Check the tree against a full recomputation of the shortest paths on the current state of Q.
+
+        Returns
+        -------
+        bool
+            True if the distance of every node of Q agrees with a new search, every Qnode removed from Q is
+            unreachable, and the distance of every node in the tree is that of its predecessor plus the weight of the
+            edge between them
+        """
+        self.update()
+        C = self.G.compiled()
+        s = C.get_index(self.source)
+        dist = csgraph.dijkstra(C.weights("add_" + self.cost_type), directed=True, indices=s)
+
+        # Distances of the nodes of Q
+        index = np.array([self.C.index.get(node, -1) for node in C.nodes], dtype=np.int64)
+        if np.any(index < 0) or np.any(self._removed[index]) or not np.allclose(self.dist[index], dist):
+            return False
+
+        # Nodes that are no longer in Q
+        gone = np.ones(len(self.C), dtype=bool)
+        gone[index] = False
+        if np.any(np.isfinite(self.dist[gone])):
+            return False
+
+        # Consistency of the tree
+        for v in np.flatnonzero(self.pred >= 0):
+            entry = self._entry(self.pred[v], v)
+            if entry is None or not np.isclose(self.dist[self.pred[v]] + self._weights[entry], self.dist[v]):
+                return False
+        return True
+
+
+def _shortest_path_rows(graph, sources, method):
+    # Shortest path lengths from a chunk of sources. Module level so that it can be sent to worker processes.
+    return csgraph.shortest_path(graph, method=method, directed=True, indices=sources)
+
+
+def best_cost_matrix(Q, cost_type=None, sources=None, targets=None, method='auto', processes=None):
+    """
+    Get the lowest path costs between many pairs of nodes at once.
+
+    This gives the same costs as best_path_cost for every (source, target) pair, including the compensation with
+    1/2 head cost and 1/2 tail cost, but runs all queries on the compiled graph (see Qnet.compile) with
+    scipy.sparse.csgraph.
+
+    Parameters
+    ----------
+    Q: Qnet()
+        Qnet graph
+    cost_type: str, optional
+        Any valid cost type from the cost vector. If None, a matrix is returned for each cost type.
+    sources: list, optional
+        Qnodes (or names) of the rows of the matrix. (The default is None, which uses all nodes in the order of
+        Q.nodes)
+    targets: list, optional
+        Qnodes (or names) of the columns of the matrix. (The default is None, which uses all nodes in the order of
+        Q.nodes)
+    method: str {'auto', 'D', 'FW', 'J', 'BF'}, optional
+        Shortest path method of scipy.sparse.csgraph.shortest_path. 'FW' (Floyd-Warshall) runs over all nodes and is
+        only used when sources is None. (The default is 'auto')
+    processes: int, optional
+        Number of worker processes to split the sources over. (The default is None, which runs in this process)
+
+    Returns
+    -------
+    array or dict [str, array]
+        (len(sources), len(targets)) array of the lowest path costs. Pairs with no path between them get the cost of
+        an infinite additive cost (i.e. e = 0)
+
+    Examples
+    --------
+    Every pair agrees with best_path_cost, with any method, and pairs in different components get e = 0 and f = 0.5
+    >>> import random
+    >>> random.seed(0)
+    >>> Q = QNET.Qnet()
+    >>> for i in range(8):
+    ...     Q.add_qnode(name=str(i), e=random.uniform(0.8, 1), f=random.uniform(0.8, 1))
+    >>> for i in range(10):
+    ...     u, v = random.sample(range(6), 2)
+    ...     Q.add_qchan(edge=[str(u), str(v)], e=random.uniform(0.5, 1), f=random.uniform(0.6, 1))
+    >>> consistent = []
+    >>> for method in ['auto', 'FW', 'D']:
+    ...     matrices = best_cost_matrix(Q, method=method)
+    ...     for i, source in enumerate(Q.nodes):
+    ...         for j, target in enumerate(Q.nodes):
+    ...             for cost_type in ['e', 'f']:
+    ...                 if nx.has_path(Q, source, target):
+    ...                     expected = best_path_cost(Q, source, target, cost_type)
+    ...                 else:
+    ...                     expected = {'e': 0, 'f': 0.5}[cost_type]
+    ...                 consistent.append(bool(np.isclose(matrices[cost_type][i, j], expected)))
+    >>> all(consistent), len(consistent)
+    (True, 384)
+    >>> best_cost_matrix(Q, 'e', sources=['0', '6'], targets=['1']).shape
+    (2, 1)
+    >>> bool(np.allclose(best_cost_matrix(Q, 'f', processes=2), matrices['f']))
+    True
+    """
+    conversions = Q.conversions
+    if cost_type is None:
+        cost_types = list(conversions)
+    else:
+        assert cost_type in conversions, \
+            f"Invalid cost type. \"{cost_type}\" not in {str([key for key in conversions])}"
+        cost_types = [cost_type]
+
+    C = Q.compiled()
+    if sources is None:
+        source_index = np.arange(len(C))
+    else:
+        source_index = np.array([C.get_index(node) for node in sources], dtype=np.int64)
+    if targets is None:
+        target_index = np.arange(len(C))
+    else:
+        target_index = np.array([C.get_index(node) for node in targets], dtype=np.int64)
+
+    if method == 'FW' and sources is not None:
+        method = 'auto'
+
+    matrices = {}
+    for cost in cost_types:
+        # Change cost type to additive
+        add_cost_type = "add_" + cost
+        graph = C.weights(add_cost_type)
 
-        def weight(u, v, d):
-            node_u_wt = u.costs[costType]
-            node_v_wt = v.costs[costType]
-            # Attempts to get edge weight, returns 1 if not found
-            edge_wt = d.get(costType, 1)
-            return node_u_wt / 2 + node_v_wt / 2 + edge_wt
-            # Note that shortest path cost will need to be compensated with 1/2 head and 1/2 tail cost
+        if processes is None or len(source_index) < 2:
+            if method == 'FW':
+                dist = csgraph.shortest_path(graph, method=method, directed=True)
+            else:
+                dist = _shortest_path_rows(graph, source_index, method)
+        else:
+            chunks = np.array_split(source_index, min(processes, len(source_index)))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+                rows = list(executor.map(_shortest_path_rows, [graph] * len(chunks), chunks, [method] * len(chunks)))
+            dist = np.vstack(rows)
+        dist = dist[:, target_index]
 
-        return weight
+        # Compensate shortest path cost with 1/2 head cost and 1/2 tail cost
+        node_cost = C.node_costs[add_cost_type]
+        dist = dist + node_cost[source_index, None] / 2 + node_cost[None, target_index] / 2
 
-    source = Q.getNode(source)
-    target = Q.getNode(target)
+        # Convert additive costs back to multiplicative costs
+        matrices[cost] = conversions[cost][1](dist)
 
+    if cost_type is None:
+        return matrices
+    return matrices[cost_type]
+
+
+def pareto_paths(Q, source, target, cost_types=None, bounds=None, max_front=None, max_labels=None):
+    """
+    Find the paths between two nodes that are Pareto optimal over several costs at once.
+
+    A path is Pareto optimal (non-dominated) if no other path is at least as good in every cost. This performs a
+    multi-objective label-setting search over the additive costs: labels are settled in lexicographic order of their
+    costs, and a label is pruned as soon as it is dominated by a settled label at the same node or by a path already
+    on the front.
+
+    Parameters
+    ----------
+    Q: Qnet()
+        Qnet graph
+    source: Union[str, Qnode]
+        Source node
+    target: Union[str, Qnode]
+        Target node
+    cost_types: list, optional
+        Cost types to optimize over. (The default is None, which uses all cost types of Q)
+    bounds: dict [str, float], optional
+        Dictionary between cost types and their worst acceptable value. i.e. {'e': 0.8} only keeps paths with an
+        efficiency of at least 0.8. Bounds are applied to the additive costs, so paths are pruned during the search.
+    max_front: int, optional
+        Stop the search once this many paths are on the front
+    max_labels: int, optional
+        Maximum number of labels settled at any node. This bounds the search on large graphs, at the cost of
+        possibly missing some of the front.
+
+    Returns
+    -------
+    list
+        Non-dominated QNET.Paths, in lexicographic order of their additive costs
+    """
+    conversions = Q.conversions
+    if cost_types is None:
+        cost_types = list(conversions)
+    for cost_type in cost_types:
+        assert cost_type in conversions, \
+            f"Invalid cost type. \"{cost_type}\" not in {str([key for key in conversions])}"
+    add_cost_types = ["add_" + cost_type for cost_type in cost_types]
+
+    C = Q.compiled()
+    s = C.get_index(source)
+    t = C.get_index(target)
+    assert s is not None and t is not None, "Source and target must be in Q"
+
+    # Weights of each CSR entry for each cost, and the node costs that compensate the head and tail
+    weights = np.column_stack([C.weights(cost_type).data for cost_type in add_cost_types])
+    node_costs = np.column_stack([C.node_costs[cost_type] for cost_type in add_cost_types])
+
+    # Largest additive cost allowed for each cost type
+    limit = np.full(len(cost_types), np.inf)
+    if bounds is not None:
+        for cost_type, value in bounds.items():
+            assert cost_type in cost_types, f"Bounded cost type \"{cost_type}\" is not in {cost_types}"
+            limit[cost_types.index(cost_type)] = conversions[cost_type][0](value)
+
+    def dominated(cost, labels):
+        # True if any of the labels is at least as good as cost in every cost type
+        for other in labels:
+            if all(other[i] <= cost[i] for i in range(len(cost))):
+                return True
+        return False
+
+    def within_bounds(cost, node):
+        # The cost of any completed path through node is at least this
+        lower = cost + node_costs[s] / 2 + node_costs[node] / 2
+        return bool(np.all(lower <= limit))
+
+    # labels[i] = (cost, node, parent label)
+    labels = [(node_costs[s] * 0, s, None)]
+    heap = [(tuple(labels[0][0]), 0)]
+    settled = [[] for i in range(len(C))]
+    front = []
+
+    while len(heap) > 0:
+        key, label_id = heapq.heappop(heap)
+        cost, node, parent = labels[label_id]
+
+        if dominated(key, settled[node]) or dominated(key, [labels[i][0] for i in front]):
+            continue
+        if max_labels is not None and len(settled[node]) >= max_labels:
+            continue
+        settled[node].append(key)
+
+        if node == t:
+            front.append(label_id)
+            if max_front is not None and len(front) >= max_front:
+                break
+            continue
+
+        for entry in range(C.indptr[node], C.indptr[node + 1]):
+            nbr = C.indices[entry]
+            new_cost = cost + weights[entry]
+            if not within_bounds(new_cost, nbr):
+                continue
+            new_key = tuple(new_cost)
+            if dominated(new_key, settled[nbr]):
+                continue
+            labels.append((new_cost, nbr, label_id))
+            heapq.heappush(heap, (new_key, len(labels) - 1))
+
+    # Reconstruct the paths on the front
+    paths = []
+    for label_id in front:
+        indices = []
+        while label_id is not None:
+            cost, node, label_id = labels[label_id]
+            indices.append(node)
+        paths.append(C.to_path(indices[::-1]))
+    return paths
+
+
+def constrained_best_path(Q, source, target, cost_type, bounds):
+    """
+    Find the path that optimises a cost type, subject to bounds on other costs.
+
+    i.e. constrained_best_path(Q, 'A', 'B', 'f', {'e': 0.8}) gives the path with the best fidelity out of all paths
+    with an efficiency of at least 0.8. This is answered with a single pareto_paths search.
+
+    Parameters
+    ----------
+    Q: Qnet()
+        Qnet graph
+    source: Union[str, Qnode]
+        Source node
+    target: Union[str, Qnode]
+        Target node
+    cost_type: str
+        The cost type to optimise
+    bounds: dict [str, float]
+        Dictionary between cost types and their worst acceptable value
+
+    Returns
+    -------
+    QNET.Path
+        The optimal path, or None if no path is within the bounds
+    """
+    cost_types = [cost_type] + [cost for cost in bounds if cost != cost_type]
+    paths = pareto_paths(Q, source, target, cost_types, bounds)
+    if len(paths) == 0:
+        return None
+    # Paths are in lexicographic order, so the first path has the lowest additive cost of cost_type
+    return paths[0]
+
+
+def _residual_dijkstra(num_nodes, tails, heads, costs, residual, potential, source):
+    # Dijkstra over the residual arcs with reduced costs. Parallel arcs are reduced to the cheapest one, which is
+    # returned for each node as the arc it was reached by.
+    arcs = np.nonzero(residual)[0]
+    reduced = costs[arcs] + potential[tails[arcs]] - potential[heads[arcs]]
+    # Reduced costs are nonnegative up to rounding
+    reduced = np.maximum(reduced, 0)
+
+    order = np.lexsort((reduced, heads[arcs], tails[arcs]))
+    arcs, reduced = arcs[order], reduced[order]
+    first = np.ones(len(arcs), dtype=bool)
+    first[1:] = (tails[arcs][1:] != tails[arcs][:-1]) | (heads[arcs][1:] != heads[arcs][:-1])
+    arcs, reduced = arcs[first], reduced[first]
+
+    graph = scipy.sparse.csr_matrix((reduced, (tails[arcs], heads[arcs])), shape=(num_nodes, num_nodes))
+    dist, pred = csgraph.dijkstra(graph, directed=True, indices=source, return_predecessors=True)
+
+    # Arc used to reach each node
+    arc_of = {(int(tails[a]), int(heads[a])): a for a in arcs}
+    return dist, pred, arc_of
+
+
+def disjoint_paths(Q, source, target, cost_type='f', method='edge_disjoint', k=None):
+    """
+    Find the set of disjoint paths between two nodes with the lowest total additive cost.
+
+    This is a minimum cost flow with unit capacities, solved by successive shortest paths with node potentials
+    (Suurballe / Bhandari's algorithm for k paths). Each augmentation adds one path, so the first k augmentations
+    give the best k disjoint paths, and running until no augmenting path is left gives the largest set of disjoint
+    paths with the lowest total cost.
+
+    Parameters
+    ----------
+    Q: Qnet()
+        Qnet graph
+    source: Union[str, Qnode]
+        Source node
+    target: Union[str, Qnode]
+        Target node
+    cost_type: str, optional
+        Any valid cost type from the cost vector. (The default is 'f')
+    method: str {'edge_disjoint', 'node_disjoint', 'total_disjoint'}, optional
+        edge_disjoint: No intersecting edges
+        node_disjoint: No intersecting nodes (other than source and target)
+        total_disjoint: No intersecting edges or nodes. Paths without intersecting nodes can't share an edge, so this
+        is the same as node_disjoint.
+        (The default is 'edge_disjoint')
+    k: int, optional
+        Maximum number of paths. (The default is None, which finds as many paths as possible)
+
+    Returns
+    -------
+    list
+        List of Paths, from best to worst cost
+    """
     conversions = Q.conversions
     assert cost_type in conversions, f"Invalid cost type. \"{cost_type}\" not in {str([key for key in conversions])}"
-    # Change cost type to additive
-    cost_type = "add_" + cost_type
+    if method not in ('edge_disjoint', 'node_disjoint', 'total_disjoint'):
+        raise ValueError(f"Invalid method \"{method}\"")
+    add_cost_type = "add_" + cost_type
 
-    # Calculate best cost in terms of additive cost
-    weight = get_weight_function(cost_type)
-    cost = nx.shortest_path_length(Q, source, target, weight)
-    # Compensate shortest path cost with 1/2 head cost and 1/2 tail cost
-    cost += source.costs[cost_type] / 2 + target.costs[cost_type] / 2
+    C = Q.compiled()
+    s = C.get_index(source)
+    t = C.get_index(target)
+    assert s is not None and t is not None, "Source and target must be in Q"
+    assert s != t, "Source and target must be different"
+    if k is None:
+        k = len(C.edges)
 
-    # Convert multiplicative costs back to additive costs
-    back_convert = conversions[cost_type.strip("_add")][1]
-    cost = back_convert(cost)
+    num_nodes = len(C)
+    node_cost = C.node_costs[add_cost_type]
+    u, v = C.edges[:, 0], C.edges[:, 1]
 
-    return cost
+    # Arcs of the flow network, each with a reverse arc at the next index. Each edge is an arc in both directions.
+    if method == 'edge_disjoint':
+        num_flow_nodes = num_nodes
+        weight = node_cost[u] / 2 + node_cost[v] / 2 + C.edge_costs[add_cost_type]
+        arc_tails = [u, v]
+        arc_heads = [v, u]
+        arc_costs = [weight, weight]
+        arc_caps = [np.ones(len(u)), np.ones(len(u))]
+        flow_source, flow_sink = s, t
+    else:
+        # Split each node into an in node i and an out node i + num_nodes, joined by an arc with the node cost. Only
+        # the source and target may be used by more than one path.
+        num_flow_nodes = 2 * num_nodes
+        nodes = np.arange(num_nodes)
+        node_caps = np.ones(num_nodes)
+        node_caps[[s, t]] = k
+        arc_tails = [nodes, u + num_nodes, v + num_nodes]
+        arc_heads = [nodes + num_nodes, v, u]
+        arc_costs = [node_cost, C.edge_costs[add_cost_type], C.edge_costs[add_cost_type]]
+        arc_caps = [node_caps, np.ones(len(u)), np.ones(len(u))]
+        flow_source, flow_sink = s, t + num_nodes
+
+    forward_tails = np.concatenate(arc_tails)
+    forward_heads = np.concatenate(arc_heads)
+    num_arcs = len(forward_tails)
+    tails = np.empty(2 * num_arcs, dtype=np.int64)
+    heads = np.empty(2 * num_arcs, dtype=np.int64)
+    costs = np.empty(2 * num_arcs)
+    capacity = np.zeros(2 * num_arcs)
+    tails[0::2], tails[1::2] = forward_tails, forward_heads
+    heads[0::2], heads[1::2] = forward_heads, forward_tails
+    costs[0::2] = np.concatenate(arc_costs)
+    costs[1::2] = -costs[0::2]
+    capacity[0::2] = np.concatenate(arc_caps)
+
+    # Successive shortest paths. The costs are nonnegative, so the initial potentials can be zero.
+    flow = np.zeros(2 * num_arcs)
+    potential = np.zeros(num_flow_nodes)
+    num_paths = 0
+    while num_paths < k:
+        dist, pred, arc_of = _residual_dijkstra(num_flow_nodes, tails, heads, costs, capacity - flow > 0.5,
+                                                potential, flow_source)
+        if not np.isfinite(dist[flow_sink]):
+            break
+        reachable = np.isfinite(dist)
+        potential[reachable] += dist[reachable]
+
+        # Augment one unit of flow along the path, cancelling flow on reverse arcs
+        node = flow_sink
+        while node != flow_source:
+            arc = arc_of[(int(pred[node]), int(node))]
+            flow[arc] += 1
+            flow[arc ^ 1] -= 1
+            node = pred[node]
+        num_paths += 1
+
+    # Decompose the flow into paths, following the arcs of the original graph with positive flow
+    out_arcs = {}
+    for arc in np.nonzero((flow > 0.5) & (capacity > 0))[0]:
+        # The source and target arcs of a split graph can carry more than one path
+        out_arcs.setdefault(int(tails[arc]), []).extend([int(heads[arc])] * int(round(flow[arc])))
+    paths = []
+    for i in range(num_paths):
+        walk = [flow_source]
+        while walk[-1] != flow_sink:
+            walk.append(out_arcs[walk[-1]].pop())
+        # Map split nodes back and drop repeated nodes, cutting out any zero cost cycle of the flow
+        path = []
+        for node in walk:
+            node = node % num_nodes
+            if node in path:
+                path = path[:path.index(node) + 1]
+            elif len(path) == 0 or path[-1] != node:
+                path.append(node)
+        paths.append(path)
+
+    paths.sort(key=lambda path: C.path_weight(path, add_cost_type))
+    return [C.to_path(path) for path in paths]
@@ -329,49 +329,75 @@ def temporalGen(Q, dt, n, startLayer = 0, endLayer = None):
     finalGraph : QNET Graph
         The temporal extension (including both connected and unconnected layers) of given graph Q.
 
+    Examples
+    --------
+    The settings of Q are kept and copied to the temporal graph, and the best path into any layer agrees with
+    temporal_best_path
+    >>> Q = QNET.Qnet()
+    >>> Q.cost_vector = {'e': 0.9, 'f': 0.9}
+    >>> Q.min_elevation = 30
+    >>> Q.add_qnode(name='A', qnode_type='Ground', coords=[0, 0, 0], isMemory=True, mem_e=0.95)
+    >>> Q.add_qnode(name='B', qnode_type='Ground', coords=[200, 0, 0])
+    >>> Q.add_qnode(name='S', qnode_type='Satellite', coords=[-600, 0, 500], v_cart=[20, 0])
+    >>> Q.add_qchan(edge=['A', 'S'])
+    >>> Q.add_qchan(edge=['S', 'B'])
+    >>> T = temporalGen(Q, 20, 6)
+    >>> Q.cost_vector == T.cost_vector == {'e': 0.9, 'f': 0.9}, Q.min_elevation, T.min_elevation
+    (True, 30, 30)
+    >>> head = T.getNode('0A')
+    >>> best = max(QNET.best_path_cost(T, head, tail, 'e') for tail in T.nodes
+    ...            if tail.name.endswith('B') and nx.has_path(T, head, tail))
+    >>> bool(np.isclose(best, QNET.temporal_best_path(Q, 'A', 'B', 'e', 20, 6)[1]))
+    True
     """
 
     if endLayer==None:
         endLayer = n-1
 
-    ## Create a list of time-updated graph layers ##
-    G = []
-    new_graph = copy.deepcopy(Q)
-    layer_num = 0
-    for i in range(0,n):
-        C = copy.deepcopy(new_graph)
-
-        dummy_graph = copy.deepcopy(new_graph)
-        dummy_graph.updateName(layer_num)
-        G.append(dummy_graph)
-
-        C.update(dt)
-        layer_num = layer_num + 1
-        new_graph = copy.deepcopy(C)
-
-    ## Join these time-updated graph layers ##
     assert (0 <= startLayer <= n-1), f"Out of range -- 0 <= startLayer <= n-1 "
     assert (0 <= endLayer <= n-1), f"Out of range -- 0 <= endLayer <= n-1 "
     assert (startLayer <= endLayer), f"startLayer <= endLayer <= n-1 "
 
-
     finalGraph = QNET.Qnet()
+    Q._copy_settings(finalGraph)
+
+    ## Add the time-updated graph layers in one pass ##
+    # Q itself is stepped forward and restored afterwards. The Qnodes of each layer are named after their layer, so
+    # each layer gets shallow copies of the Qnodes, which share their cost vectors with Q, and satellites get their
+    # own copy of their time dependent state.
+    snapshot = Q.snapshot()
+    Q.cacheEphemeris(n * dt, dt)
+    layers = []
+    try:
+        for layer_num in range(0, n):
+            layer = {}
+            for node in Q.nodes():
+                new_node = copy.copy(node)
+                new_node.name = str(layer_num) + node.name
+                if isinstance(node, QNET.Satellite):
+                    new_node.setState(node.getState())
+                layer[node] = new_node
+            layers.append(layer)
+
+            finalGraph.add_nodes_from(layer.values())
+            finalGraph.add_edges_from((layer[u], layer[v], dict(d)) for u, v, d in Q.edges(data=True))
+
+            if layer_num < n - 1:
+                Q.update(dt)
+    finally:
+        Q.rollback(snapshot)
 
-    for layer_num in range(0, len(G)):
-        finalGraph = nx.compose(finalGraph, G[layer_num])
-        #print(finalGraph)
-
+    ## Join these time-updated graph layers ##
     for node in Q.nodes():
         for layer_num in range(startLayer+1, endLayer+1):
             if node.isMemory and layer_num>0:
-                u = finalGraph.getNode(str(layer_num-1)+node.name)
-                v = finalGraph.getNode(str(layer_num)+node.name)
+                u = layers[layer_num-1][node]
+                v = layers[layer_num][node]
                 finalGraph.add_memory_qchan(edge=[u, v], e = u.memory['mem_e'], f = u.memory['mem_f'])
 
     return finalGraph
 
 
-
 def percolate(Q, prob, head_tail_method):
     """
     Percolates a graph with some probability, making sure not to remove particular nodes of interest (head, tail)
@@ -392,3 +418,44 @@ def percolate(Q, prob, head_tail_method):
                 kill_list.append(node)
     C.remove_nodes_from(kill_list)
     return C, head, tail
+
+
+def percolation_mask(Q, prob, keep=None, rng=None, num_masks=None):
+    """
+    Draws a survival mask for the nodes of a graph, where each node not in keep is removed with some probability.
+
+    The mask follows the order of Q.nodes, so it can be used with percolate_view without copying the graph.
+
+    :param Q: Qnet Graph
+    :param prob: Probability of removing a given node not in keep
+    :param keep: List of Qnodes that are never removed (i.e. head and tail nodes)
+    :param rng: Optional numpy random Generator
+    :param num_masks: Optional number of masks to draw at once. If None, a single mask is drawn.
+    :return: Boolean array of shape (len(Q),) or (num_masks, len(Q)). True where the node survives.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    shape = len(Q) if num_masks is None else (num_masks, len(Q))
+    mask = rng.random(shape) >= prob
+
+    if keep is not None:
+        keep = set(keep)
+        keep_index = [i for i, node in enumerate(Q.nodes) if node in keep]
+        mask[..., keep_index] = True
+    return mask
+
+
+def percolate_view(Q, mask, index=None):
+    """
+    Percolates a graph with a survival mask from percolation_mask. Nothing is copied: the percolated graph is a
+    read-only view of Q that hides the removed nodes.
+
+    :param Q: Qnet Graph
+    :param mask: Boolean array over the nodes of Q, in the order of Q.nodes
+    :param index: Optional dictionary between Qnodes and their position in Q.nodes. Pass it in when percolating the
+    same graph many times to avoid rebuilding it.
+    :return: Percolated graph view
+    """
+    if index is None:
+        index = {node: i for i, node in enumerate(Q.nodes)}
+    return Q.subgraph_view(filter_node=lambda node: mask[index[node]])
@@ -6,31 +6,133 @@ import statistics as stats
 import scipy.stats as sp
 import copy
 import random
+import concurrent.futures
 
-def percolate(Q, prob, head_tail_method):
+def percolate(Q, prob, head_tail_method, rng=None):
     """
     Percolates a graph with some probability, making sure not to remove particular nodes of interest (head, tail)
     :param Q: Qnet Graph
     :param prob: Probability of not removing a given node not in (head, tail)
     :param head: Qnode
     :param tail: Qnode
+    :param rng: Optional numpy random Generator. If None, the random module is used.
     :return: Percolated Graph, head node, tail node
     """
     C = copy.deepcopy(Q)
     head, tail = head_tail_method(C)
+    # head and tail may be lists of nodes
+    keep = set(head if isinstance(head, list) else [head]) | set(tail if isinstance(tail, list) else [tail])
 
     kill_list = []
     for node in C.nodes():
-        xd = random.uniform(0,1)
+        if rng is None:
+            xd = random.uniform(0,1)
+        else:
+            xd = rng.random()
         if xd < prob:
-            if node not in (head, tail):
+            if node not in keep:
                 kill_list.append(node)
     C.remove_nodes_from(kill_list)
     return C, head, tail
 
 
+def run_trials(protocols, head_tail_method, Q, num_iters, prob, protocol_kwargs=None, exception_methods=None,
+               rng=None, percolation='copy'):
+    """
+    Runs a list of protocols against num_iters percolated instances of Q for a single percolation density.
+
+    For details on the arguments, see monte_method.
+
+    :param float prob: Percolation density
+    :param rng: Optional numpy random Generator used for percolation. If None, the random module is used for 'copy'
+    percolation and a fresh Generator for 'mask' percolation.
+    :param str percolation: Either 'copy' or 'mask'
+    :return: A list of the cost vectors collected for each protocol
+    """
+    assert percolation in ('copy', 'mask'), f"Unsupported percolation: \'{percolation}\'"
+    costs = [[] for k in range(len(protocols))]
+
+    if percolation == 'mask':
+        # Head and tail nodes are taken from Q itself since the percolated graphs are views of Q
+        head, tail = head_tail_method(Q)
+        keep = (head if isinstance(head, list) else [head]) + (tail if isinstance(tail, list) else [tail])
+        # Survival masks of every trial, drawn at once
+        masks = QNET.percolation_mask(Q, prob, keep, rng, num_masks=num_iters)
+        compiled = Q.compile()
+        index = compiled.index
+
+        # Check if paths exist between all head and tail pairs, for every trial in one pass
+        heads = [index[node] for node in (head if isinstance(head, list) else [head])]
+        tails = [index[node] for node in (tail if isinstance(tail, list) else [tail])]
+        all_paths_exist = QNET.connected_pairs(len(compiled), compiled.edges, heads, tails, masks).all(axis=1)
+
+    for iter_index in range(num_iters):
+        # Percolate the graph and get head - tail nodes. Views are only made for trials that run the protocols
+        if percolation == 'mask':
+            if all_paths_exist[iter_index]:
+                P = QNET.percolate_view(Q, masks[iter_index], index)
+        else:
+            P, head, tail = percolate(Q, prob, head_tail_method, rng)
+        assert head is not None and tail is not None
+
+        # If head_tail method returns a list of nodes for head and tail, check they're the same size
+        if isinstance(head, list) or isinstance(tail, list):
+            assert len(head) == len(tail)
+
+        # Check if paths exist between all head and tail pairs, with one connected components pass
+        if percolation == 'mask':
+            paths_exist = bool(all_paths_exist[iter_index])
+        elif isinstance(head, list) or isinstance(tail, list):
+            paths_exist = bool(QNET.pairs_connected(P, head, tail).all())
+        else:
+            paths_exist = bool(QNET.pairs_connected(P, [head], [tail]).all())
+
+        # If paths do exist, run each of the protocols against the graphs
+        if paths_exist is True:
+            for proto_index in range(len(protocols)):
+                # Get protocol kwargs
+                if protocol_kwargs is not None:
+                    kwargs = protocol_kwargs[proto_index]
+                else:
+                    kwargs = {}
+
+                # Get cost_vector from the protocol
+                cost_vector = protocols[proto_index](P, head, tail, **kwargs)
+                # Add the cost vector to the array
+                costs[proto_index].append(cost_vector)
+
+        # Else if no paths exist between head and tail nodes, try running exception methods
+        else:
+            if exception_methods is not None:
+                # Run exception_methods for costs
+                for method_index in range(len(exception_methods)):
+                    if exception_methods[method_index] is not None:
+                        cost_vector = exception_methods[method_index]()
+                        # Add cost_vector to the array
+                        costs[method_index].append(cost_vector)
+
+    return costs
+
+
+# Arguments of run_trials that are shared by every task of a worker process. They are set once per worker by
+# _init_worker so that the graph is sent to each worker once, rather than with every task.
+_worker_args = None
+
+
+def _init_worker(protocols, head_tail_method, Q, protocol_kwargs, exception_methods, percolation):
+    global _worker_args
+    _worker_args = (protocols, head_tail_method, Q, protocol_kwargs, exception_methods, percolation)
+
+
+def _worker_trials(num_iters, prob, seed):
+    protocols, head_tail_method, Q, protocol_kwargs, exception_methods, percolation = _worker_args
+    rng = np.random.default_rng(seed)
+    return run_trials(protocols, head_tail_method, Q, num_iters, prob, protocol_kwargs, exception_methods, rng,
+                      percolation)
+
+
 def monte_method(protocols, head_tail_method, Q, num_iters, num_steps, protocol_kwargs=None, exception_methods=None,
-                 percolation_range=None):
+                 percolation_range=None, processes=None, seed=None, chunk_size=None, percolation='copy'):
     """
     This function runs a list of protocols against multiples instances of pseudo-random graphs and returns the costs for
     each. One or more communication parties are selected with head_tail_method. The graphs are then generated by taking
@@ -73,6 +175,29 @@ def monte_method(protocols, head_tail_method, Q, num_iters, num_steps, protocol_
     :param percolation_range: (float, float)
     Optional: The range of percolation density this function runs over.
 
+    :param int processes:
+    Optional: Number of worker processes to spread the trials over. If None, all trials are run in this process.
+    Each worker receives Q and the protocols once, when it starts. Protocols, head_tail_method and exception methods
+    must be picklable if the platform starts processes with "spawn".
+
+    :param int seed:
+    Optional: Seed for the percolation. Every block of chunk_size trials gets its own random stream spawned from the
+    seed, so results are reproducible for any number of processes. If None and processes is None, the random module
+    is used as before.
+
+    :param int chunk_size:
+    Optional: Number of trials per task. (The default is num_iters, i.e. one task per percolation density)
+
+    :param str percolation:
+    Optional: How graphs are percolated. 'mask' draws a boolean survival mask for each trial and runs the protocols
+    on a read-only view of Q (see QNET.percolate_view), so nothing is copied. head_tail_method is called once on Q.
+    'copy' takes a deepcopy of Q for each trial and removes nodes from it, for protocols that need to modify the
+    graph they are given. (The default is 'copy')
+
+    'mask' is much faster on large graphs, but is opt-in since it changes how trials are run: head_tail_method is
+    called once rather than per trial, protocols can't modify the views they are given, and the percolation is drawn
+    from a numpy Generator rather than the random module.
+
     :return: A two dimensional cost array. The first index is the protocol used, the second is the percolation density.
     Each value is a tuple containing the mean and variance:
 
@@ -100,53 +225,49 @@ def monte_method(protocols, head_tail_method, Q, num_iters, num_steps, protocol_
     else:
         defect_probs = np.linspace(0, 1, num_steps)
 
+    if chunk_size is None:
+        chunk_size = num_iters
+    assert chunk_size > 0
+
+    # Split the trials of each percolation density into tasks of (prob_index, num_iters, seed)
+    tasks = []
+    if seed is None and processes is None:
+        # Use the random module
+        step_seeds = [None] * num_steps
+    else:
+        step_seeds = np.random.SeedSequence(seed).spawn(num_steps)
+    for prob_index in range(num_steps):
+        chunks = [min(chunk_size, num_iters - i) for i in range(0, num_iters, chunk_size)]
+        if step_seeds[prob_index] is None:
+            chunk_seeds = [None] * len(chunks)
+        else:
+            chunk_seeds = step_seeds[prob_index].spawn(len(chunks))
+        for i in range(len(chunks)):
+            tasks.append((prob_index, chunks[i], chunk_seeds[i]))
+
     # Initalize cost_array
     # cost_array == cost_array[cost_type][protocol][num_step]
     cost_array = [[[] for j in range(num_steps)] for k in range(len(protocols))]
 
-    for prob_index in range(num_steps):
-        for iter_index in range(num_iters):
-            # Percolate the graph and get head - tail nodes
-            P, head, tail = percolate(Q, defect_probs[prob_index], head_tail_method)
-            assert head is not None and tail is not None
-
-            # If head_tail method returns a list of nodes for head and tail, check they're the same size
-            if isinstance(head, list) or isinstance(tail, list):
-                assert len(head) == len(tail)
-
-            # Check if paths exist between all head and tail pairs
-            paths_exist = True
-            if isinstance(head, list) or isinstance(tail, list):
-                for i in range(len(head)):
-                    if not nx.has_path(P, head[i], tail[i]):
-                        paths_exist = False
-            else:
-                if nx.has_path(P, head, tail) is False:
-                    paths_exist = False
-
-            # If paths do exist, run each of the protocols against the graphs
-            if paths_exist is True:
-                for proto_index in range(len(protocols)):
-                    # Get protocol kwargs
-                    if protocol_kwargs is not None:
-                        kwargs = protocol_kwargs[proto_index]
-                    else:
-                        kwargs = {}
-
-                    # Get cost_vector from the protocol
-                    cost_vector = protocols[proto_index](P, head, tail, **kwargs)
-                    # Add the cost vector to the array
-                    cost_array[proto_index][prob_index].append(cost_vector)
-
-            # Else if no paths exist between head and tail nodes, try running exception methods
-            else:
-                if exception_methods is not None:
-                    # Run exception_methods for costs
-                    for method_index in range(len(exception_methods)):
-                        if exception_methods[method_index] is not None:
-                            cost_vector = exception_methods[method_index]()
-                            # Add cost_vector to the array
-                            cost_array[method_index][prob_index].append(cost_vector)
+    if processes is None:
+        results = []
+        for prob_index, iters, chunk_seed in tasks:
+            rng = None if chunk_seed is None else np.random.default_rng(chunk_seed)
+            results.append(run_trials(protocols, head_tail_method, Q, iters, defect_probs[prob_index],
+                                      protocol_kwargs, exception_methods, rng, percolation))
+    else:
+        initargs = (protocols, head_tail_method, Q, protocol_kwargs, exception_methods, percolation)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                                    initargs=initargs) as executor:
+            futures = [executor.submit(_worker_trials, iters, defect_probs[prob_index], chunk_seed)
+                       for prob_index, iters, chunk_seed in tasks]
+            results = [future.result() for future in futures]
+
+    # Merge the results of each task in order
+    for task_index in range(len(tasks)):
+        prob_index = tasks[task_index][0]
+        for proto_index in range(len(protocols)):
+            cost_array[proto_index][prob_index].extend(results[task_index][proto_index])
 
     # Process cost_array such that each data point takes the form (mean, error)
     processed_array = [[{} for i in range(num_steps)] for j in range(len(protocols))]
@@ -215,7 +336,7 @@ def path_except():
     return {'p':0}
 
 # Example code
-def example(dim, size):
+def example(dim, size, processes=None, seed=None):
     # Multidimensional lattice
     L = QNET.multidim_lattice(dim=dim, size=size, e=1, f=0.9, periodic=False)
 
@@ -258,11 +379,12 @@ def example(dim, size):
     cost_array = monte_method(protocols,
                               corner_head_tail, L, num_iters=300, num_steps=20,
                               protocol_kwargs=p_kwargs, exception_methods=e_methods,
-                              percolation_range=(0, 0.7))
+                              percolation_range=(0, 0.7), processes=processes, seed=seed)
 
     # Plot cost array
     plot_monte_method(cost_array, protocols=protocols,
                       title=f"Graph of Different Protocol Costs Against a {dim}^{size} Lattice",
                       percolation_range=(0, 0.7))
 
-example(dim = 3, size = 3)
\ No newline at end of file
+if __name__ == "__main__":
+    example(dim = 3, size = 3)
\ No newline at end of file
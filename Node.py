@@ -44,7 +44,8 @@ class Qnode:
 
         self.name = name
         self.coords = coords
-        self.costs = cost_vector
+        # Cost vectors are kept as CostDicts, so that changes to them are seen by the Qnets that hold the Qnode
+        self._costs = QNET.CostDict(cost_vector)
         self.memory = memory_vector
         self.isMemory = isMemory
 
@@ -54,6 +55,18 @@ class Qnode:
     def __repr__(self):
         return self.name
 
+    @property
+    def costs(self):
+        return self._costs
+
+    @costs.setter
+    def costs(self, cost_vector):
+        # The new cost vector is held by the same Qnets as the old one
+        owners = self._costs._owners
+        self._costs = QNET.CostDict(cost_vector)
+        self._costs._owners = owners
+        self._costs._edited()
+
     def update(self, Q, from_default=True, **kwargs):
         """
         Updates the attributes of a given qnode
@@ -107,6 +120,162 @@ class Ground(Qnode):
         super().__init__(Q, name, coords, **kwargs)
 
 
+# Constants of the barometric formula used by pvlib.atmosphere.alt2pres:
+# P(h) = 100 * ((PRES_A - h) / PRES_B) ** PRES_K
+PRES_A = 44331.514
+PRES_B = 11880.516
+PRES_K = 1 / 0.1902632
+
+# Temperature (K) and specific gas constant (J/(kg K)) of air. Assume T = 288.15K and 0% humidity
+AIR_T = 288.15
+AIR_R = 287.058
+
+# Attenuation coefficient of the air channel
+AIR_K = 0.005
+
+
+def effective_density(theta, dist, method='analytic'):
+    """
+    Calculate the effective air density along the lines of sight of satellite channels
+
+    The effective density is the line integral of the air density along a line of sight of length L' with altitude
+    angle theta:
+
+      / L'
+     |     rho(L * sin(theta)) dL
+    /   0
+
+    Where rho is found from the pvlib barometric formula with the ideal gas law. The barometric formula is a power
+    of the altitude, so the integral has the closed form
+
+    100 * B * A^(k+1) / ((k+1) * sin(theta)) * (1 - (1 - L' * sin(theta) / a)^(k+1)) / (R * T)
+
+    where A = a / B. Above the altitude a the pressure of the formula vanishes, so the integrand is set to zero there.
+
+    Parameters
+    ----------
+    theta : float or array of floats
+        Altitude angles of the lines of sight (in radians)
+    dist : float or array of floats
+        Lengths of the lines of sight
+    method : str {'analytic', 'quad'}, optional
+        'analytic' evaluates the closed form for all lines of sight in one NumPy call. 'quad' performs the line
+        integral numerically with scipy.integrate.quad for each line of sight, and is kept as a reference.
+        (The default is 'analytic')
+
+    Returns
+    -------
+    float or array of floats
+        Effective density for each line of sight
+
+    Examples
+    --------
+    The closed form agrees with the numerical line integral on lines of sight below the altitude a
+    >>> theta, dist = np.meshgrid(np.radians([0.5, 5, 30, 60, 90]), [1, 100, 1000, 10000, 40000])
+    >>> analytic = effective_density(theta, dist)
+    >>> bool(np.allclose(analytic, effective_density(theta, dist, method='quad'), rtol=1e-9))
+    True
+    """
+    theta = np.asarray(theta, dtype=float)
+    dist = np.asarray(dist, dtype=float)
+
+    if method == 'quad':
+        def rho(L, theta):
+            # From altitude, calculate pressure
+            P = atmosphere.alt2pres(L * np.sin(theta))
+            return P / (AIR_R * AIR_T)
+
+        quad = np.vectorize(lambda t, l: scipy.integrate.quad(rho, 0, l, args=(t))[0])
+        return quad(theta, dist)[()]
+
+    assert method == 'analytic', f"Unsupported method: \'{method}\'"
+
+    sin = np.sin(theta)
+    # Fraction of the pressure altitude a climbed along the line of sight (Clipped to where the pressure vanishes)
+    x = np.minimum(dist * sin / PRES_A, 1)
+    scale = 100 * PRES_B * (PRES_A / PRES_B) ** (PRES_K + 1) / (PRES_K + 1) / (AIR_R * AIR_T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # -expm1((k+1) * log1p(-x)) == 1 - (1 - x)^(k+1), without the cancellation for lines of sight near the ground
+        d = scale * -np.expm1((PRES_K + 1) * np.log1p(-x)) / sin
+    # A horizontal line of sight stays at ground pressure
+    horizontal = 100 * (PRES_A / PRES_B) ** PRES_K / (AIR_R * AIR_T) * dist
+    d = np.where(sin == 0, horizontal, d)
+    return d[()]
+
+
+def air_costs(theta, dist, method='analytic'):
+    """
+    Calculate the efficiency and fidelity of satellite channels from their lines of sight
+
+    Parameters
+    ----------
+    theta : float or array of floats
+        Altitude angles of the lines of sight (in radians)
+    dist : float or array of floats
+        Lengths of the lines of sight
+    method : str {'analytic', 'quad'}, optional
+        Integration method of effective_density.
+        (The default is 'analytic')
+
+    Returns
+    -------
+    (float, float) or (array of floats, array of floats)
+        "e" Probability of survival and "f" probability of no phase flip for each line of sight
+    """
+    d = effective_density(theta, dist, method)
+    e = np.exp(-AIR_K * d)
+    f = (1 + np.exp(-AIR_K * d)) / 2
+    return e, f
+
+
+# Mean radius of the Earth (km) for geodesic coordinates
+EARTH_RADIUS = 6371.0
+
+
+def ecef(lat, lon, alt=0):
+    """
+    Get the Earth-centred, Earth-fixed positions of geodesic coordinates on a spherical Earth
+
+    Parameters
+    ----------
+    lat, lon : float or array of floats
+        Latitudes and longitudes (in degrees)
+    alt : float or array of floats, optional
+        Altitudes above the surface (in km). The default is 0.
+
+    Returns
+    -------
+    array
+        (..., 3) array of positions (in km)
+    """
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    r = EARTH_RADIUS + np.asarray(alt, dtype=float)
+    return np.stack([r * np.cos(lat) * np.cos(lon), r * np.cos(lat) * np.sin(lon), r * np.sin(lat)], axis=-1)
+
+
+def footprint_radius(alt, min_elevation=0):
+    """
+    Get the longest line of sight from a satellite to the ground within its footprint, that is to the ground
+    locations that see the satellite at least min_elevation above the horizon (on a spherical Earth).
+
+    Parameters
+    ----------
+    alt : float or array of floats
+        Altitudes of the satellites (in km)
+    min_elevation : float, optional
+        Minimum altitude angle of the lines of sight (in degrees). The default is 0.
+
+    Returns
+    -------
+    float or array of floats
+        Length of the longest line of sight (in km)
+    """
+    r = EARTH_RADIUS + np.asarray(alt, dtype=float)
+    eps = np.radians(min_elevation)
+    return np.sqrt(np.maximum(r ** 2 - (EARTH_RADIUS * np.cos(eps)) ** 2, 0)) - EARTH_RADIUS * np.sin(eps)
+
+
 class Satellite(Qnode):
     def __init__(self, Q, name=None, coords=None, t=0, v_cart=None, line1=None,
                  line2=None, cartesian=True, **kwargs):
@@ -150,6 +319,9 @@ class Satellite(Qnode):
         """
         # Initialise coordinate type
         self.cartesian = cartesian
+        # Time (in seconds) since t_startTime and the precomputed ephemeris of the satellite (See cacheEphemeris)
+        self.t_elapsed = 0
+        self.ephemeris = None
         
         super().__init__(Q, name, coords, **kwargs)
 
@@ -174,8 +346,8 @@ class Satellite(Qnode):
                 satellite = EarthSatellite(line1, line2, self.name, ts)
                 geometry = satellite.at(t_new)
                 subpoint = geometry.subpoint()
-                self.coords = [int(subpoint.latitude.degrees), int(subpoint.longitude.degrees),
-                               int(subpoint.elevation.km)]
+                self.coords = [float(subpoint.latitude.degrees), float(subpoint.longitude.degrees),
+                               float(subpoint.elevation.km)]
             except:
                 # Add ISS Zarya to the network by default if the given TLE is invalid
                 # l1 and l2 are TLE of ISS Zarya
@@ -184,8 +356,8 @@ class Satellite(Qnode):
                 satellite = EarthSatellite(l1, l2, self.name, ts)
                 geometry = satellite.at(t_new)
                 subpoint = geometry.subpoint()
-                geo_coords = [int(subpoint.latitude.degrees), int(subpoint.longitude.degrees),
-                              int(subpoint.elevation.km)]
+                geo_coords = [float(subpoint.latitude.degrees), float(subpoint.longitude.degrees),
+                              float(subpoint.elevation.km)]
                 super().__init__(Q, name, geo_coords, **kwargs)
 
             # TODO: Write descriptions for these variables here
@@ -198,17 +370,25 @@ class Satellite(Qnode):
             print(t_now.utc)
 
     def posUpdate(self, dt):
+        self.t_elapsed = self.t_elapsed + dt
+
         if self.cartesian is True:
             vx = self.velocity[0]
             vy = self.velocity[1]
             self.coords = [self.coords[0] + vx * dt, self.coords[1] + vy * dt, self.coords[2]]
 
         else:
-            self.t_new = self.ts.utc(self.t_new.utc[0], self.t_new.utc[1], self.t_new.utc[2], self.t_new.utc[3],
-                                     self.t_new.utc[4], self.t_new.utc[5] + dt)
-            geometry = self.satellite.at(self.t_new)
-            subpoint = geometry.subpoint()
-            self.coords = [int(subpoint.latitude.degrees), int(subpoint.longitude.degrees), int(subpoint.elevation.km)]
+            i = self.ephemerisIndex()
+            if i is not None:
+                self.t_new = self.ephemeris['times'][i]
+                self.coords = self.ephemeris['coords'][i].tolist()
+            else:
+                self.t_new = self.ts.utc(self.t_new.utc[0], self.t_new.utc[1], self.t_new.utc[2], self.t_new.utc[3],
+                                         self.t_new.utc[4], self.t_new.utc[5] + dt)
+                geometry = self.satellite.at(self.t_new)
+                subpoint = geometry.subpoint()
+                self.coords = [float(subpoint.latitude.degrees), float(subpoint.longitude.degrees),
+                               float(subpoint.elevation.km)]
 
         return
 
@@ -224,8 +404,88 @@ class Satellite(Qnode):
 
         '''
         self.t_new = self.t_startTime
+        self.t_elapsed = 0
+        return
+
+    def getState(self):
+        """
+        Returns a copy of the time dependent attributes of the satellite. (See setState)
+        """
+        state = {'coords': list(self.coords), 't_elapsed': self.t_elapsed}
+        if self.cartesian is False:
+            state['t_new'] = self.t_new
+        return state
+
+    def setState(self, state):
+        """
+        Restores the time dependent attributes of the satellite from the output of getState
+        """
+        for attr in state:
+            setattr(self, attr, state[attr])
+        self.coords = list(self.coords)
+        return
+
+    def cacheEphemeris(self, tMax, dt):
+        """
+        Precompute the ephemeris of a satellite initialised with TLEs.
+
+        The satellite is propagated over the time grid getTimeArr(tMax, dt), starting from its current time, in one
+        vectorized skyfield call. Whenever the satellite lies on this grid, posUpdate, distance and airGeometry
+        become lookups into the cached arrays. Off the grid, the satellite is propagated as usual.
+
+        Cartesian satellites are not affected.
+
+        Parameters
+        ----------
+        tMax : float
+            Timespan of the ephemeris
+        dt : float
+            Time increment of the ephemeris
+
+        Returns
+        -------
+        None.
+        """
+        if self.cartesian is True:
+            return
+
+        offsets = self.t_elapsed + QNET.getTimeArr(tMax, dt)
+        t0 = self.t_startTime.utc
+        times = self.ts.utc(t0[0], t0[1], t0[2], t0[3], t0[4], t0[5] + offsets)
+        subpoint = self.satellite.at(times).subpoint()
+        coords = np.column_stack([subpoint.latitude.degrees, subpoint.longitude.degrees, subpoint.elevation.km])
+
+        # 'topocentric' is filled lazily by getTopocentric with the line of sight to each ground location
+        self.ephemeris = {'dt': dt, 'offsets': offsets, 'times': times, 'coords': coords, 'topocentric': {}}
         return
 
+    def ephemerisIndex(self):
+        """
+        Returns the index of the current time in the cached ephemeris, or None if it isn't on the time grid.
+        """
+        if self.ephemeris is None:
+            return None
+        offsets = self.ephemeris['offsets']
+        if len(offsets) == 0:
+            return None
+        i = int(round((self.t_elapsed - offsets[0]) / self.ephemeris['dt']))
+        if 0 <= i < len(offsets) and np.isclose(offsets[i], self.t_elapsed):
+            return i
+        return None
+
+    def getTopocentric(self, node):
+        """
+        Get the altitude angles (in degrees) and distances (in km) between a ground location and the satellite over
+        the time grid of the cached ephemeris.
+        """
+        key = (float(node.coords[0]), float(node.coords[1]))
+        topocentric = self.ephemeris['topocentric']
+        if key not in topocentric:
+            difference = self.satellite - Topos(key[0], key[1])
+            alt, az, distMagnitude = difference.at(self.ephemeris['times']).altaz()
+            topocentric[key] = (alt.degrees, distMagnitude.km)
+        return topocentric[key]
+
     def cart_distance(self, node):
         sx, sy, sz = self.coords
         x, y, z = node.coords
@@ -238,24 +498,31 @@ class Satellite(Qnode):
             return np.sqrt((x - sx) ** 2 + (y - sy) ** 2 + (z - sz) ** 2)
 
         else:
+            i = self.ephemerisIndex()
+            if i is not None:
+                alt, distMagnitude = self.getTopocentric(node)
+                return int(distMagnitude[i] / 1000)
+
             node_location = Topos(float(node.coords[0]), float(node.coords[1]))
             difference = self.satellite - node_location
             topocentric = difference.at(self.t_new)
             alt, az, distMagnitude = topocentric.altaz()
             return int(distMagnitude.km / 1000)
 
-    def airCost(self, node):
-        """
-        :param Qnode() node: The target node for the satellite communication
-        :return list: [e, p] -- [Transmission probability, phasing probability]
+    def airGeometry(self, node):
         """
+        Get the geometry of the line of sight between the satellite and a node.
 
-        # TODO:
-        """
-        We want the aircost to be able to return both the efficiency and p,
-        but this requires more advanced understanding of how e and p change with
-        effective density.
-        
+        Parameters
+        ----------
+        node : Qnode
+            The target node for the satellite communication
+
+        Returns
+        -------
+        (float, float)
+            Altitude angle (in radians, for both Cartesian and geodesic satellites, as expected by air_costs) and
+            length of the line of sight
         """
         if self.cartesian is True:
             # Straight line distance between nodes
@@ -267,57 +534,35 @@ class Satellite(Qnode):
             theta = np.arcsin(dz / dist)
 
         else:
-            node_location = Topos(float(node.coords[0]), float(node.coords[1]))
-            difference = self.satellite - node_location
-            topocentric = difference.at(self.t_new)
-            alt, az, dist1 = topocentric.altaz()
-            theta = alt.degrees
-            dist = self.distance(node)
+            i = self.ephemerisIndex()
+            if i is not None:
+                alt, distMagnitude = self.getTopocentric(node)
+                theta = np.radians(alt[i])
+                dist = int(distMagnitude[i] / 1000)
+            else:
+                node_location = Topos(float(node.coords[0]), float(node.coords[1]))
+                difference = self.satellite - node_location
+                topocentric = difference.at(self.t_new)
+                alt, az, dist1 = topocentric.altaz()
+                theta = np.radians(alt.degrees)
+                dist = self.distance(node)
+
+        return theta, dist
 
+    def airCost(self, node):
         """
-        Line integral for effective density
-            
-          / L'
-         |     rho(L * sin(theta)) dL
-        /   0
+        :param Qnode() node: The target node for the satellite communication
+        :return list: [e, f] -- [Transmission probability, fidelity]
         """
 
-        def rho(L, theta):
-
-            # From altitude, calculate pressure
-            # Assume T = 288.15K and 0% humidity
-            P = atmosphere.alt2pres(L * np.sin(theta))
-            T = 288.15
-            R = 287.058  # Specific gas constant of air
-            return P / (R * T)
-
-        # Perform numerical integration to get effective density (?)
-        # d = scipy.integrate.quad(rho, 0, int(dist.km/1000), args = (theta))[0]
-        d = scipy.integrate.quad(rho, 0, dist, args=(theta))[0]
-
-        def get_efficiency(d):
-            """
-            Calculate efficiency for the transmission given effective density
-            :param float d: Effective density
-            :return float: "p" Probability of survival
-            """
-
-            # Attenuation coefficient
-            K = 0.005
-            return np.exp(-K*d)
-            # return QNET.convert(d * K, 'linear')
-
-        def get_fidelity(d):
-            """
-            Calculate fidelity for the transmission given effective density
-            :param float d: Effective density
-            :return float: "e" probability of no phase flip.
-            """
-
-            # Attenuation coefficient
-            K = 0.005
-            return (1 + np.exp(-K*d))/2
-            # return QNET.convert(d * K, 'linear')
+        # TODO:
+        """
+        We want the aircost to be able to return both the efficiency and p,
+        but this requires more advanced understanding of how e and p change with
+        effective density.
+        
+        """
+        theta, dist = self.airGeometry(node)
 
         ## Check if satellite is above the horizon before making an edge ##
         '''
@@ -327,7 +572,8 @@ class Satellite(Qnode):
             results = [0,0]
         '''
 
-        results = [get_efficiency(d), get_fidelity(d)]
+        e, f = air_costs(theta, dist)
+        results = [e, f]
 
         return results
 
@@ -9,15 +9,19 @@ Created on Tue Mar 24 12:00:05 2020
 import networkx as nx
 import QNET
 import numpy as np
-import collections
+from collections import deque
 
 
 class Path:
+    # Paths are created in large numbers by the protocols and path searches, so they have no __dict__ and their cost
+    # vector is computed on demand
+    __slots__ = ('G', 'node_array', '_costs', '_cost_vector', '_version')
+
     def __init__(self, G, array):
         assert (isinstance(G, QNET.Qnet)), "path.__init__ requires reference to the graph containing the path"
         assert (array != None), "path.__init__ received an empty array"
 
-        node_array = []
+        node_array = deque()
         for node in array:
             node = G.getNode(node)
             assert node is not None
@@ -25,17 +29,86 @@ class Path:
 
         self.G = G
         self.node_array = node_array
-        self.head = node_array[0]
-        self.tail = node_array[len(self.node_array) - 1]
-        self.cost_vector = self.get_cost_vector()
+
+        # Running sums of the costs along the path, and the cost vector made from them. Both are computed on demand
+        # and are only valid for the version of G they were computed at.
+        self._costs = None
+        self._cost_vector = None
+        self._version = None
 
         # Assert path is valid in G
         # Maybe we could just incorperate this into is_valid instead?
-        if all([(node_array[i], node_array[i + 1]) in G.edges() \
-                or (node_array[i + 1], node_array[i]) in G.edges() for i in range(len(node_array) - 1)]):
-            pass
-        else:
-            assert False, f"Path {self.stringify()} does not exist in Qnet."
+        for u, v in self._hops():
+            assert G.has_edge(u, v), f"Path {self.stringify()} does not exist in Qnet."
+
+    def _hops(self):
+        # Consecutive pairs of nodes along the path. node_array is a deque, so it is iterated rather than indexed.
+        nodes = iter(self.node_array)
+        prev = next(nodes, None)
+        for node in nodes:
+            yield prev, node
+            prev = node
+
+    @property
+    def head(self):
+        return self.node_array[0]
+
+    @head.setter
+    def head(self, node):
+        # Replace the first node of the path
+        node = self.G.getNode(node)
+        assert node is not None
+        if len(self.node_array) > 1:
+            assert self.G.has_edge(node, self.node_array[1]), f"head {node.name} is not adjacent to the path"
+        self.node_array[0] = node
+        self._costs = None
+        self._cost_vector = None
+
+    @property
+    def tail(self):
+        return self.node_array[-1]
+
+    @tail.setter
+    def tail(self, node):
+        # Replace the last node of the path
+        node = self.G.getNode(node)
+        assert node is not None
+        if len(self.node_array) > 1:
+            assert self.G.has_edge(node, self.node_array[-2]), f"tail {node.name} is not adjacent to the path"
+        self.node_array[-1] = node
+        self._costs = None
+        self._cost_vector = None
+
+    @property
+    def cost_vector(self):
+        """
+        Cost vector of the path. It is cached until the costs of G change (see Qnet.version), including changes made
+        by hand to the costs of nodes or edges (see CostDict).
+
+        A path extended with append and prepend has the costs of the same path made in one go, and the product of the
+        costs of its nodes and edges
+        >>> Q = QNET.Qnet()
+        >>> for name in 'ABCD':
+        ...     Q.add_qnode(name=name, e=0.9, f=0.95)
+        >>> Q.add_qchan(edge=['A', 'B'], e=0.8, f=0.9)
+        >>> Q.add_qchan(edge=['B', 'C'], e=0.7, f=0.85)
+        >>> Q.add_qchan(edge=['C', 'D'], e=0.6, f=0.8)
+        >>> path = Path(Q, ['B', 'C'])
+        >>> cost = path.cost_vector['e']
+        >>> path.append('D')
+        >>> path.prepend('A')
+        >>> full = Path(Q, ['A', 'B', 'C', 'D'])
+        >>> path.node_array, all(np.isclose(path.cost_vector[c], full.cost_vector[c]) for c in full.cost_vector)
+        (deque([A, B, C, D]), True)
+        >>> bool(np.isclose(path.cost_vector['e'], 0.9 ** 4 * 0.8 * 0.7 * 0.6))
+        True
+        >>> Q.getNode('C').costs['add_e'] = QNET.to_log(0.5)
+        >>> bool(np.isclose(path.cost_vector['e'], 0.9 ** 3 * 0.5 * 0.8 * 0.7 * 0.6))
+        True
+        """
+        if self._cost_vector is None or self._version != self.G.version:
+            self._cost_vector = self.get_cost_vector()
+        return self._cost_vector
 
     def __str__(self):
         return "Path: " + self.stringify() + ", Cost: " + str(self.cost_vector)
@@ -56,35 +129,32 @@ class Path:
                 break
         return has_ground
 
-    def get_cost_vector(self):
-        # List of cost vectors for all elements in the path:
-        element_cvs = []
-
-        # Get cost vectors of edges
-        path_len = len(self.node_array)
-        i = 0
-        while i < path_len - 1:
-            cur = self.node_array[i]
-            nxt = self.node_array[i + 1]
-            edge_data = self.G.get_edge_data(cur, nxt)
-            element_cvs.append(edge_data)
-            i += 1
-
-        # Get cost vectors of nodes
+    def _sum_costs(self):
+        # Sum the cost vectors of all edges and nodes in the path, or return the running sums if they're up to date
+        version = self.G.version
+        if self._costs is not None and self._version == version:
+            return self._costs
+
+        costs = {}
+        for u, v in self._hops():
+            edge_data = self.G.get_edge_data(u, v)
+            for cost_type, cost in edge_data.items():
+                costs[cost_type] = costs.get(cost_type, 0) + cost
         for node in self.node_array:
-            element_cvs.append(node.costs)
+            for cost_type, cost in node.costs.items():
+                costs[cost_type] = costs.get(cost_type, 0) + cost
 
-        # Cost vectors have identical keys
-        # Sum all key elements together, convert additive costs to correct value, update dictionary
-        def sum_cost_vectors(cv_list):
-            counter = collections.Counter()
-            for d in cv_list:
-                counter.update(d)
-            return dict(counter)
+        self._costs = costs
+        self._cost_vector = None
+        self._version = version
+        return costs
+
+    def get_cost_vector(self):
+        # Sum all costs of the edges and nodes in the path
+        new_cv = dict(self._sum_costs())
 
-        new_cv = sum_cost_vectors(element_cvs)
         # Convert additive costs into regular costs:
-        for cost_type in new_cv:
+        for cost_type in self._costs:
             if cost_type.startswith("add_"):
                 # Get additive cost
                 cost = new_cv[cost_type]
@@ -95,9 +165,58 @@ class Path:
 
         return new_cv
 
-    # TODO Test this
+    def _extend(self, node, edge_data):
+        # Add the costs of a new hop to the running sums, if they're up to date
+        if self._costs is not None and self._version == self.G.version:
+            for d in (edge_data, node.costs):
+                for cost_type, cost in d.items():
+                    self._costs[cost_type] = self._costs.get(cost_type, 0) + cost
+        else:
+            self._costs = None
+        self._cost_vector = None
+
+    def append(self, node):
+        """
+        Extend the path by one hop at its tail. The cost vector is updated in constant time.
+
+        :param node: Qnode (or name) adjacent to the tail of the path
+        :return: None
+        """
+        node = self.G.getNode(node)
+        assert node is not None
+        edge_data = self.G.get_edge_data(self.tail, node)
+        assert edge_data is not None, f"Path {self.stringify()}-{node.name} does not exist in Qnet."
+        self.node_array.append(node)
+        self._extend(node, edge_data)
+
+    def prepend(self, node):
+        """
+        Extend the path by one hop at its head. The cost vector is updated in constant time.
+
+        :param node: Qnode (or name) adjacent to the head of the path
+        :return: None
+        """
+        node = self.G.getNode(node)
+        assert node is not None
+        edge_data = self.G.get_edge_data(node, self.head)
+        assert edge_data is not None, f"Path {node.name}-{self.stringify()} does not exist in Qnet."
+        self.node_array.appendleft(node)
+        self._extend(node, edge_data)
+
+    def copy(self):
+        """
+        Copy the path, sharing its graph and running sums
+        """
+        path = Path.__new__(Path)
+        path.G = self.G
+        path.node_array = deque(self.node_array)
+        path._costs = None if self._costs is None else dict(self._costs)
+        path._cost_vector = self._cost_vector
+        path._version = self._version
+        return path
+
     def subgraph(self):
-        return self.G.subgraph(self.array)
+        return self.G.subgraph(self.node_array)
 
     def stringify(self):
         """
@@ -108,24 +227,12 @@ class Path:
 
         """
         # Given a path, returns a string of the path
-        pString = ""
-        i = 0
-        while i < len(self.node_array):
-            pString = pString + str(self.node_array[i].name)
-            i += 1
-            if i < len(self.node_array):
-                pString = pString + "-"
-        return pString
+        return "-".join(str(node.name) for node in self.node_array)
 
     def remove_edges(self):
         """
         Remove all edges in path from the graph G
         :return: None
         """
-        path_len = len(self.node_array)
-        i = 0
-        while i < path_len - 1:
-            cur = self.node_array[i]
-            nxt = self.node_array[i + 1]
+        for cur, nxt in list(self._hops()):
             self.G.remove_edge(cur, nxt)
-            i += 1
@@ -9,11 +9,129 @@ used to reduce Qnet graphs
 """
 
 import copy
+import concurrent.futures
 import numpy as np
 import networkx as nx
 import QNET
 
 
+# States of the swapping scan in simple_swap: no Ground seen yet, a front Ground seen, and a front Ground and a swap
+# candidate seen. _SWAP_TRANSITIONS[state, kind] is the next state after a node of each kind (other, Ground, Swapper).
+# A Ground seen in the candidate state closes a segment, and the scan starts again.
+_NO_GROUND, _FRONT_GROUND, _CANDIDATE = 0, 1, 2
+_SWAP_TRANSITIONS = np.array([[_NO_GROUND, _FRONT_GROUND, _NO_GROUND],
+                              [_FRONT_GROUND, _FRONT_GROUND, _CANDIDATE],
+                              [_CANDIDATE, _NO_GROUND, _CANDIDATE]])
+
+
+def linear_chain(Q, source, dest):
+    """
+    Get the only path between two nodes, in linear time.
+
+    The path is unique if and only if every edge of a path between the nodes is a bridge. If its ends have degree one
+    and all of its inner nodes have degree two, the component is the path itself and this is already known. Otherwise
+    the bridges of the component are found with one depth first search.
+
+    :param Q: Qnet Graph
+    :param source: Source node (or name)
+    :param dest: Destination node (or name)
+    :return: List of Qnodes from source to dest
+    """
+    source = Q.getNode(source)
+    dest = Q.getNode(dest)
+
+    # Check that path exists from A to B
+    assert(nx.has_path(Q, source, dest)), f"No valid path exists between {source.name} and {dest.name}."
+    chain = nx.shortest_path(Q, source, dest)
+
+    # If more than one path exists, raise exception
+    is_path = Q.degree(source) == 1 and Q.degree(dest) == 1 and all(Q.degree(node) == 2 for node in chain[1:-1])
+    if not is_path:
+        bridges = set(nx.bridges(Q, root=source))
+        unique = all((chain[i], chain[i + 1]) in bridges or (chain[i + 1], chain[i]) in bridges
+                     for i in range(len(chain) - 1))
+        assert unique, "More than one path exists, linear reduction cannot be done."
+
+    return chain
+
+
+def swap_chains(Q, chains):
+    """
+    Vectorized simple_swap for many linear chains at once, such as all rows of a lattice.
+
+    The chains are not checked for being the only path between their ends (see linear_chain).
+
+    :param Q: Qnet Graph
+    :param chains: List of chains, each a list of nodes (or names) with an edge between consecutive nodes
+    :return: Arrays of the no_swap and swap efficiencies of each chain
+    """
+    nodes = [Q.getNode(node) for chain in chains for node in chain]
+    lengths = np.array([len(chain) for chain in chains], dtype=np.int64)
+    assert np.all(lengths > 1), "Chains must have at least two nodes"
+    assert None not in nodes, "Chain nodes must be in Q"
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    ends = starts + lengths - 1
+    chain_of = np.repeat(np.arange(len(chains)), lengths)
+
+    node_e = np.array([node.costs['e'] for node in nodes])
+    kind = np.array([2 if isinstance(node, QNET.Swapper) else 1 if isinstance(node, QNET.Ground) else 0
+                     for node in nodes])
+    swap_prob = np.array([node.swap_prob if isinstance(node, QNET.Swapper) else 0 for node in nodes])
+    # Efficiency of the edge after each node. The last node of a chain gets 1.
+    edge_e = np.ones(len(nodes))
+    is_end = np.zeros(len(nodes), dtype=bool)
+    is_end[ends] = True
+    for i in np.nonzero(~is_end)[0]:
+        edge_data = Q.get_edge_data(nodes[i], nodes[i + 1])
+        assert edge_data is not None, f"Chain {nodes[i].name}-{nodes[i + 1].name} does not exist in Qnet."
+        edge_e[i] = edge_data['e']
+
+    # Cost of each chain without any swapping
+    element_e = node_e * edge_e
+    no_swap = np.multiply.reduceat(element_e, starts)
+
+    # State of the scan before each node, as a prefix composition of the transitions. The first node of each chain
+    # is applied to the initial state, which cuts off the chains before it.
+    maps = _SWAP_TRANSITIONS[:, kind].T.copy()
+    maps[starts] = _SWAP_TRANSITIONS[_NO_GROUND, kind[starts]][:, None]
+    step = 1
+    while step < len(nodes):
+        maps[step:] = np.take_along_axis(maps[step:], maps[:-step], axis=1)
+        step *= 2
+    after = maps[:, _NO_GROUND]
+    before = np.concatenate([[_NO_GROUND], after[:-1]])
+    before[starts] = _NO_GROUND
+
+    # Grounds in the candidate state close a segment. The destination of a chain is never scanned.
+    closes = np.nonzero(~is_end & (kind == 1) & (before == _CANDIDATE))[0]
+
+    # Segments run from the edge after the previous closing Ground to the next closing Ground (or the end of the
+    # chain). Elements alternate between nodes and the edges after them, so the product of a segment is a reduceat.
+    element = np.empty(2 * len(nodes))
+    element[0::2] = node_e
+    element[1::2] = edge_e
+    segment_starts = np.sort(np.concatenate([2 * starts, 2 * closes + 1]))
+    segment_e = np.multiply.reduceat(element, segment_starts)
+    segment_chain = chain_of[segment_starts // 2]
+    net_eff = np.minimum(1, np.minimum.reduceat(segment_e, np.searchsorted(segment_chain, np.arange(len(chains)))))
+
+    # The best swapper of each closed segment is the first with the highest swap_prob. Swappers are only candidates
+    # after a front Ground, and only count if their segment is closed in the same chain.
+    segment_of = np.searchsorted(closes, np.arange(len(nodes)))
+    candidates = np.nonzero((kind == 2) & (before != _NO_GROUND) & ~is_end)[0]
+    candidates = candidates[segment_of[candidates] < len(closes)]
+    candidates = candidates[chain_of[closes[segment_of[candidates]]] == chain_of[candidates]]
+    order = np.lexsort((candidates, -swap_prob[candidates], segment_of[candidates]))
+    candidates = candidates[order]
+    first = np.ones(len(candidates), dtype=bool)
+    first[1:] = segment_of[candidates][1:] != segment_of[candidates][:-1]
+    swappers = candidates[first]
+
+    # Multiply net_eff with the costs of all swappers used.
+    np.multiply.at(net_eff, chain_of[swappers], node_e[swappers])
+    return no_swap, net_eff
+
+
 def simple_swap(Q, source, dest):
     """
     Given a linear graph or subgraph, this function calculates the efficiency from head to tail if all valid swapper
@@ -34,120 +152,11 @@ def simple_swap(Q, source, dest):
     and e[T] is taken to mean the efficiency cost of performing a swap with the node T.
 
     """
-    # Check that path exists from A to B
-    assert(nx.has_path(Q, source, dest))
-
-    # Create generator of paths from A to B. If no generator exists raise exception
-    path_gen = nx.all_simple_paths(Q, source, dest)
-    assert (path_gen != None), f"No valid path exists between {source.name} and {dest.name}."
-
-    #  Unpack generator. If more than one path exists, raise exception
-    path_count = 0
-    for obj in path_gen:
-        path = QNET.Path(Q, obj)
-        path_count += 1
-
-    assert(path_count == 1), "More than one path exists, linear reduction cannot be done."
-
-    # Does a Swapper with swapping potential exist?
-    swap_candidate = None
-    # Does ground exist before a swapper?
-    front_ground = False
-    # Local efficiency of a Ground - Swapper - Ground configuration (or equivalent)
-    local_eff = 1
-    # list of swapper nodes used in the swapping process
-    swap_list = []
-    # Total efficiency of path
-    net_eff = 1
-
-    # Current node
-    cur = source
-    # Counter
-    i = 0
-
-    while cur != dest:
-        # If current node is a Ground and we haven't seen a Swapper yet, set front_ground to True
-        if isinstance(cur, QNET.Ground) and swap_candidate is None:
-            # Add node eff to local
-            local_eff *= cur.costs['e']
-            front_ground = True
-
-        # If Current node is a Swapper and we've seen a ground node previously, we now have a candidate for a swapper
-        # that could be used.
-        elif isinstance(cur, QNET.Swapper) and front_ground is True:
-            swap_switch = True
-            if swap_candidate == None:
-                swap_candidate = cur
-            # If we had another swap candidate previously, update swap_candidate to be better efficiency option
-            elif swap_candidate.swap_prob < cur.swap_prob:
-                swap_candidate = cur
-            local_eff *= cur.costs['e']
-
-        # If current node is a Ground and we've seen a Swapper, we perform a swap with the local resources
-        # (Front-Ground, Swapper, Back-Ground) and update net_eff.
-        elif isinstance(cur, QNET.Ground) and swap_candidate is not None:
-            # Add node eff to local
-            local_eff *= cur.costs['e']
-
-            # Update net_eff to local_eff if net_eff is smaller
-            if local_eff < net_eff:
-                net_eff = local_eff
-
-            # Add the swapper we were considering to the list of swappers used
-            swap_list.append(swap_candidate)
-
-            # Reset parameters to prepare for the next swap
-            local_eff = 1
-            swap_candidate = None
-            front_ground = False
-
-        # Otherwise include the node cost in the local efficiency
-        else:
-            local_eff *= cur.costs['e']
-
-        # Increment counter and get the edge efficiency
-        i += 1
-        edge_costs = Q.get_edge_data(cur, path.node_array[i])
-
-        # Update local_eff with edge efficiency
-        local_eff *= edge_costs['e']
-        # Move to next node
-        cur = path.node_array[i]
-
-        # If the new node is the destination
-        if cur == dest:
-            # Append node costs from dest
-            local_eff *= cur.costs['e']
-            # Update net_eff to local_eff if net_eff is smaller
-            # This also handles the case where no valid swapper was encountered
-            if local_eff < net_eff:
-                 net_eff = local_eff
-
-    # Multiply net_eff with the costs of all swappers used.
-    for swapper in swap_list:
-        net_eff *= swapper.costs['e']
-
-    """Calculate cost of path without any swapping"""
-    # Cost of path without swapping
-    no_swap = 1
-    # Length of path
-    path_len = len(path.node_array)
-    i = 0
-
-    # Sum all edge efficiencies
-    while (i < path_len - 1):
-        cur = path.node_array[i]
-        nxt = path.node_array[i + 1]
-        edgeData = path.G.get_edge_data(cur, nxt)
-        no_swap *= edgeData['e']
-        i += 1
-
-    # Sum all node efficiencies except for swappers
-    for node in path.node_array:
-        no_swap *= node.costs['e']
+    chain = linear_chain(Q, source, dest)
+    no_swap, net_eff = swap_chains(Q, [chain])
 
     # DEBUG: For now, return both swap and no swap:
-    return(no_swap, net_eff)
+    return(no_swap[0], net_eff[0])
 
     """
     # Return whatever cost is better
@@ -160,44 +169,59 @@ def simple_swap(Q, source, dest):
 def fidTransform(F1, F2):
     return (F1 * F2) / (F1 * F2 + (1 - F1) * (1 - F2))
 
-def purify(Q, source, target):
+def purify(Q, source, target, method="node_disjoint", threshold=None):
     """
 
     This function performs a multi-path entanglement purification between a source and target node using all
     available paths.
 
+    The disjoint paths are found with a single minimum cost flow on the additive fidelity cost (see
+    QNET.disjoint_paths), so the paths used are the set of disjoint paths with the best total fidelity.
+
     :param Q: Qnet Graph
     :param source: Name of source node
     :param target: Name of target node
-    If none, will purify all possible paths
     :param string, optional, method: The method used to do the purification.
     Supported options: "edge_disjoint", "node_disjoint", "total_disjoint", "greedy".
         edge_disjoint: No intersecting edges
         node_disjoint: No intersecting nodes
         total_disjoint: No intersecting edges or nodes
+        greedy: Repeatedly take the best remaining path and remove its edges, as in simple_purify
         Other inputs produce a ValueError
+    :param int, optional, threshold: Maximum number of paths to find before purifying.
+    If none, will purify all possible paths
     :return: float
     """
-
-    # TODO: Implement a threshold attribute so user doesn't have to iterate through all paths
-
-    def fidTransform(F1, F2):
-        return (F1 * F2) / (F1 * F2 + (1 - F1) * (1 - F2))
+    if threshold is not None:
+        assert isinstance(threshold, int)
+        assert threshold > 0
 
     # Get paths for Graph
     u = Q.getNode(source)
     v = Q.getNode(target)
 
-    # TODO: Find a better way of producing disjoint paths
-    generator = nx.node_disjoint_paths(Q, u, v)
+    if method == "greedy":
+        paths = []
+        C = Q.compiled()
+        edge_mask = np.ones(len(C.edges), dtype=bool)
+        i, j = C.get_index(u), C.get_index(v)
+        while threshold is None or len(paths) < threshold:
+            path, cost = C.shortest_path(i, j, 'f', edge_mask=edge_mask)
+            if path is None:
+                break
+            edge_mask[[C.edge_id(path[n], path[n + 1]) for n in range(len(path) - 1)]] = False
+            paths.append(C.to_path(path))
+    elif method in ["edge_disjoint", "node_disjoint", "total_disjoint"]:
+        paths = QNET.disjoint_paths(Q, u, v, 'f', method, threshold)
+    else:
+        raise ValueError(f"Invalid method \"{method}\"")
 
     # Get p values for each path
     f_arr = []
-    for path in generator:
-        new_path = QNET.Path(Q, path)
+    for path in paths:
         # check if path is valid
-        if new_path.is_valid() == True:
-            f = new_path.cost_vector['f']
+        if path.is_valid() == True:
+            f = path.cost_vector['f']
             f_arr.append(f)
         else:
             pass
@@ -243,39 +267,48 @@ def simple_purify(Q = None, head = None, tail = None, threshold = None):
     if None in [Q, head, tail]:
         return {'e': 0, 'f': 0}
 
-    # Make copy of graph
-    C = copy.deepcopy(Q)
+    # Work on the compiled graph, removing the edges of each path with an edge mask rather than from a copy of Q
+    C = Q.compiled()
+    conversions = C.conversions
+    edge_mask = np.ones(len(C.edges), dtype=bool)
 
     # Get source and target
-    head = C.getNode(head)
-    tail = C.getNode(tail)
+    head = C.get_index(head)
+    tail = C.get_index(tail)
+
+    def next_path():
+        # Find the best remaining path in terms of fidelity and remove its edges. A failed search means that no path
+        # exists, so this also does the connectivity check.
+        path, add_f = C.shortest_path(head, tail, 'f', edge_mask=edge_mask)
+        if path is None:
+            return None
+        edge_mask[[C.edge_id(path[i], path[i + 1]) for i in range(len(path) - 1)]] = False
+        f = conversions['f'][1](add_f)
+        e = conversions['e'][1](C.path_weight(path, 'add_e'))
+        return f, e
 
     # Find the best path in terms of fidelity,
-    path = QNET.best_path(C, head, tail, 'f')
-    # pur_f = path.cost('f')
-    pur_f = path.cost_vector['f']
-    # pur_e = path.cost('e')
-    pur_e = path.cost_vector['e']
-    path.remove_edges()
+    costs = next_path()
+    if costs is None:
+        raise nx.NetworkXNoPath(f"No path between {C.nodes[head].name} and {C.nodes[tail].name}.")
+    pur_f, pur_e = costs
     path_counter = 1
 
     # Purify paths against eachother until either no path exists or threshold is reached
-    while nx.has_path(C, head, tail) is True:
+    while True:
         if threshold is not None:
             if path_counter > threshold:
                 break
-        path = QNET.best_path(C, head, tail, 'f')
-        # new_f = path.cost('f')
-        new_f = path.cost_vector['f']
-        # new_e = path.cost('e')
-        new_e = path.cost_vector['e']
+        costs = next_path()
+        if costs is None:
+            break
+        new_f, new_e = costs
 
         # Efficiency is weakest-link. Update pur_e to whatever the lowest path efficiency is.
         if new_e < pur_e:
             pur_e = new_e
 
         pur_f = QNET.fidTransform(pur_f, new_f)
-        path.remove_edges()
         path_counter += 1
 
     # Each path purification requires 2*(n-1) bell projections, where n is the number of bell pairs
@@ -285,6 +318,247 @@ def simple_purify(Q = None, head = None, tail = None, threshold = None):
     return {'e':pur_e, 'f':pur_f}
 
 
+# Costs of pairs with no path between them (see batch_protocol)
+simple_purify.default = {'e': 0, 'f': 0}
+
+
+def _purify_links(add_e, add_f, conversions, f_min, max_purify):
+    # Additive costs of purifying m = 1, ..., max_purify copies of each link, along a new last axis. Purifying m
+    # copies needs all m links and 2*(m-1) bell projections with e = 1/2, and each copy is purified into the others
+    # with fidTransform. Purifications that don't bring the fidelity to at least f_min get infinite costs. Purifying
+    # more copies than needed is kept as an option, since it trades efficiency for fidelity.
+    f = conversions['f'][1](add_f)
+    copies = np.arange(1, max_purify + 1)
+    pur_f = np.empty(np.shape(add_f) + (max_purify,))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pur_f[..., 0] = f
+        for m in range(1, max_purify):
+            pur_f[..., m] = fidTransform(pur_f[..., m - 1], f)
+        new_add_e = copies * add_e[..., None] + conversions['e'][0](0.5 ** (2 * (copies - 1)))
+        new_add_f = conversions['f'][0](pur_f)
+    # Purifying a link with F <= 1/2 doesn't improve it
+    useful = (copies == 1) | (f[..., None] > 0.5)
+    keep = useful & (pur_f >= f_min) & np.isfinite(new_add_e)
+    return np.where(keep, new_add_e, np.inf), np.where(keep, new_add_f, np.inf)
+
+
+def _pareto_front(add_e, add_f):
+    # Non-dominated (add_e, add_f) labels of each row of two 2D arrays, as arrays of their rows and columns in order
+    # of row and increasing add_e. Of equal labels, one is kept. Labels with infinite costs are left out.
+    order = np.argsort(add_e, axis=1)
+    sorted_e, sorted_f = np.take_along_axis(add_e, order, axis=1), np.take_along_axis(add_f, order, axis=1)
+    # A label is kept if its add_f is lower than that of every label before it in its row
+    best_before = np.minimum.accumulate(sorted_f, axis=1)
+    best_before[:, 1:] = best_before[:, :-1].copy()
+    best_before[:, 0] = np.inf
+    rows, position = np.nonzero((sorted_f < best_before) & np.isfinite(sorted_e))
+    # Of labels kept with equal add_e, only the last one, of lowest add_f, is not dominated
+    e = sorted_e[rows, position]
+    dominated = (rows[:-1] == rows[1:]) & (e[:-1] == e[1:])
+    keep = np.ones(len(rows), dtype=bool)
+    keep[:-1] = ~dominated
+    return rows[keep], order[rows[keep], position[keep]]
+
+
+def repeater_chain(path, f_min=None, max_purify=8, max_front=None):
+    """
+    Find the nested entanglement swapping and purification schedule of a repeater chain with the best efficiency.
+
+    The stations of the chain are its head, its tail and the Swappers on it. Any two stations can share a link
+    through the path between them, and a link between stations i and j can also be made by swapping links (i, k)
+    and (k, j) at a station k between them. Swapping multiplies the efficiencies of the links with the efficiency and
+    swap_prob of the Swapper, and adds the additive fidelities of the links and the Swapper.
+
+    If f_min is given, every link must be purified (see fidTransform) to a fidelity of at least f_min before it is
+    used, as in a nested purification scheme. A link made from less efficient sub-links of higher fidelity may need
+    fewer copies purified further up, so each segment of the chain keeps the Pareto front of the (efficiency,
+    fidelity) of its links, as in pareto_paths. The fronts are built by dynamic programming from the shortest
+    segments up. The swaps at every station of a segment are combined in a single array operation, so the search
+    takes O(n^2) steps in the number of stations, each of O(n) times the cost of combining two fronts. The fronts
+    can grow quickly on chains with many stations, in which case they can be bounded with max_front.
+
+    Without f_min, nothing is purified, and the direct link between the head and tail is always best: a swap only
+    multiplies in the swap_prob of the Swapper, on top of the costs the direct link already has. The cost of the
+    path is then returned directly with the schedule ('link', head, tail).
+
+    :param path: QNET.Path of the chain
+    :param float, optional, f_min: Fidelity every link must reach. If None, links are not purified.
+    :param int, optional, max_purify: Maximum number of copies purified together
+    :param int, optional, max_front: Maximum number of links kept on the front of each segment, keeping the most
+    efficient. This bounds the search on long chains, at the cost of possibly missing the best schedule.
+    :return: (cost vector, schedule). The schedule is a nested tuple of ('link', u, v), ('swap', node, left, right)
+    and ('purify', m, link). If no schedule reaches f_min, returns ({'e': 0, 'f': 0}, None).
+
+    Examples
+    --------
+    Without f_min, the direct link has the costs of the path. With f_min, the best link agrees with trying every
+    schedule of a chain with one Swapper, where purifying only the poorer half before the swap is best
+    >>> Q = QNET.Qnet()
+    >>> Q.add_qnode(name='A')
+    >>> Q.add_qnode(name='S', qnode_type='Swapper', swap_prob=0.9)
+    >>> Q.add_qnode(name='B')
+    >>> Q.add_qchan(edge=['A', 'S'], e=0.5, f=0.99)
+    >>> Q.add_qchan(edge=['S', 'B'], e=0.9, f=0.85)
+    >>> P = QNET.Path(Q, ['A', 'S', 'B'])
+    >>> cost_vector, schedule = repeater_chain(P)
+    >>> bool(cost_vector['e'] == P.cost_vector['e']), bool(cost_vector['f'] == P.cost_vector['f']), schedule
+    (True, True, ('link', A, B))
+    >>> to_f, from_f = Q.conversions['f']
+    >>> def purified(e, f):
+    ...     # The link purified with 1 to 4 copies, where it reaches a fidelity of 0.9
+    ...     links, pf = [], f
+    ...     for m in range(1, 5):
+    ...         if m > 1:
+    ...             pf = fidTransform(pf, f)
+    ...         if pf >= 0.9:
+    ...             links.append((e ** m * 0.25 ** (m - 1), pf))
+    ...     return links
+    >>> links = purified(P.cost_vector['e'], P.cost_vector['f'])
+    >>> for e1, f1 in purified(0.5, 0.99):
+    ...     for e2, f2 in purified(0.9, 0.85):
+    ...         links += purified(e1 * e2 * 0.9, from_f(to_f(f1) + to_f(f2)))
+    >>> cost_vector, schedule = repeater_chain(P, f_min=0.9, max_purify=4)
+    >>> bool(np.isclose(cost_vector['e'], max(links)[0])), schedule
+    (True, ('swap', S, ('link', A, S), ('purify', 2, ('link', S, B))))
+    """
+    G = path.G
+    conversions = G.conversions
+    nodes = list(path.node_array)
+    num_nodes = len(nodes)
+
+    # Additive costs of the nodes and of the edge after each node
+    node_ae = np.array([node.costs['add_e'] for node in nodes])
+    node_af = np.array([node.costs['add_f'] for node in nodes])
+    edge_ae = np.array([G.edges[nodes[i], nodes[i + 1]]['add_e'] for i in range(num_nodes - 1)] + [0])
+    edge_af = np.array([G.edges[nodes[i], nodes[i + 1]]['add_f'] for i in range(num_nodes - 1)] + [0])
+
+    # Stations and the cost of swapping at each of them
+    stations = np.array([i for i in range(num_nodes) if i in (0, num_nodes - 1) or isinstance(nodes[i], QNET.Swapper)])
+    num_stations = len(stations)
+    if num_stations < 2:
+        return {'e': 0, 'f': 0}, None
+
+    # Without purification, the direct link between the head and tail is best
+    if f_min is None:
+        ae, af = node_ae.sum() + edge_ae.sum(), node_af.sum() + edge_af.sum()
+        cost_vector = {'e': conversions['e'][1](ae), 'f': conversions['f'][1](af)}
+        return cost_vector, ('link', nodes[0], nodes[-1])
+
+    swap_prob = np.array([getattr(nodes[i], 'swap_prob', 1) for i in stations])
+    with np.errstate(divide='ignore'):
+        swap_ae = node_ae[stations] + conversions['e'][0](swap_prob)
+    swap_af = node_af[stations]
+
+    # Direct links between every pair of stations, from prefix sums over the path. The head and tail costs are
+    # included in the links that end at them.
+    def prefix(a):
+        return np.concatenate([[0], np.cumsum(a)])
+    edge_ae_sum, edge_af_sum = prefix(edge_ae), prefix(edge_af)
+    node_ae_sum, node_af_sum = prefix(node_ae), prefix(node_af)
+
+    def direct(a, b):
+        pa, pb = stations[a], stations[b]
+        ae = edge_ae_sum[pb] - edge_ae_sum[pa] + node_ae_sum[pb] - node_ae_sum[pa + 1]
+        af = edge_af_sum[pb] - edge_af_sum[pa] + node_af_sum[pb] - node_af_sum[pa + 1]
+        ae = ae + (a == 0) * node_ae[0] + (b == num_stations - 1) * node_ae[-1]
+        af = af + (a == 0) * node_af[0] + (b == num_stations - 1) * node_af[-1]
+        return ae, af
+
+    # Fronts of the links between every two stations a and b, as arrays over (a, b, label) padded with inf costs:
+    # the additive costs, the station the link was swapped at (-1 for a direct link), the labels of the two sub-links
+    # it was swapped from, and the number of copies purified. The number of labels grows as fronts grow.
+    width = 1 if max_front is None else max_front
+    front_ae = np.full((num_stations, num_stations, width), np.inf)
+    front_af = np.full((num_stations, num_stations, width), np.inf)
+    front_k, front_l, front_r, front_m = [np.full((num_stations, num_stations, width), -1, dtype=np.int64)
+                                          for i in range(4)]
+
+    # Segments of the same length don't depend on each other, so they are built together
+    for length in range(1, num_stations):
+        a = np.arange(num_stations - length)
+        b = a + length
+        k = a[:, None] + np.arange(1, length)
+
+        # Candidates of each segment: a swap at every station k between a and b of any two sub-links, indexed as
+        # (k - a - 1, left label, right label), then the direct link
+        swaps = (len(a), (length - 1) * width ** 2)
+        cand_ae = (front_ae[a[:, None], k][..., :, None] + front_ae[k, b[:, None]][..., None, :] +
+                   swap_ae[k][..., None, None]).reshape(swaps)
+        cand_af = (front_af[a[:, None], k][..., :, None] + front_af[k, b[:, None]][..., None, :] +
+                   swap_af[k][..., None, None]).reshape(swaps)
+        ae, af = direct(a, b)
+        cand_ae = np.concatenate([cand_ae, ae[:, None]], axis=1)
+        cand_af = np.concatenate([cand_af, af[:, None]], axis=1)
+
+        # Purifying keeps the order of links that dominate each other, so only the front of the candidates is
+        # purified. The front of each segment is laid out on a row, padded with inf costs.
+        segment, column = _pareto_front(cand_ae, cand_af)
+        position = np.arange(len(segment)) - np.searchsorted(segment, segment)
+        raw_column = np.full((len(a), np.max(position, initial=0) + 1), -1)
+        raw_column[segment, position] = column
+        raw_ae, raw_af = np.full(raw_column.shape, np.inf), np.full(raw_column.shape, np.inf)
+        raw_ae[segment, position], raw_af[segment, position] = cand_ae[segment, column], cand_af[segment, column]
+        pur_ae, pur_af = _purify_links(raw_ae, raw_af, conversions, f_min, max_purify)
+        pur_ae, pur_af = pur_ae.reshape(len(a), -1), pur_af.reshape(len(a), -1)
+
+        # Label of each link kept on the front of its segment
+        segment, column = _pareto_front(pur_ae, pur_af)
+        label = np.arange(len(segment)) - np.searchsorted(segment, segment)
+        if max_front is not None:
+            segment, column, label = segment[label < max_front], column[label < max_front], label[label < max_front]
+
+        # Decode the candidates kept
+        copies = column % max_purify + 1
+        swap = raw_column[segment, column // max_purify]
+        is_swap = swap < swaps[1]
+        split = np.where(is_swap, segment + 1 + swap // width ** 2, -1)
+        left = np.where(is_swap, swap // width % width, -1)
+        right = np.where(is_swap, swap % width, -1)
+
+        if len(label) > 0 and label.max() >= width:
+            # Widen the fronts of every segment to fit the largest one
+            pad = ((0, 0), (0, 0), (0, label.max() + 1 - width))
+            front_ae = np.pad(front_ae, pad, constant_values=np.inf)
+            front_af = np.pad(front_af, pad, constant_values=np.inf)
+            front_k, front_l, front_r, front_m = [np.pad(array, pad, constant_values=-1)
+                                                  for array in (front_k, front_l, front_r, front_m)]
+            width = label.max() + 1
+
+        end = segment + length
+        front_ae[segment, end, label], front_af[segment, end, label] = pur_ae[segment, column], pur_af[segment, column]
+        front_k[segment, end, label], front_l[segment, end, label], front_r[segment, end, label] = split, left, right
+        front_m[segment, end, label] = copies
+
+    # The most efficient link between the head and tail is first on its front
+    top = num_stations - 1
+    if not np.isfinite(front_ae[0, top, 0]):
+        return {'e': 0, 'f': 0}, None
+
+    # Build the schedule from the bottom up
+    schedule = {}
+    stack = [(0, top, 0)]
+    while len(stack) > 0:
+        a, b, label = stack[-1]
+        k = front_k[a, b, label]
+        if k != -1:
+            sub = [(a, k, front_l[a, b, label]), (k, b, front_r[a, b, label])]
+            missing = [key for key in sub if key not in schedule]
+            if len(missing) > 0:
+                stack += missing
+                continue
+        stack.pop()
+        if k == -1:
+            link = ('link', nodes[stations[a]], nodes[stations[b]])
+        else:
+            link = ('swap', nodes[stations[k]], schedule[sub[0]], schedule[sub[1]])
+        if front_m[a, b, label] > 1:
+            link = ('purify', int(front_m[a, b, label]), link)
+        schedule[(a, b, label)] = link
+
+    cost_vector = {'e': conversions['e'][1](front_ae[0, top, 0]), 'f': conversions['f'][1](front_af[0, top, 0])}
+    return cost_vector, schedule[(0, top, 0)]
+
+
 def best_costs(P = None, head = None, tail = None):
     # Default cost_array
     if None in [P, head, tail]:
@@ -296,6 +570,9 @@ def best_costs(P = None, head = None, tail = None):
     return cost_vector
 
 
+best_costs.default = {'e': 0, 'f': 0}
+
+
 def path_exist(P=None, head=None, tail=None):
     if None in [P, head, tail]:
         return {'p': 0}
@@ -303,8 +580,122 @@ def path_exist(P=None, head=None, tail=None):
         if not nx.has_path(P, head, tail):
             return{'p': 0}
     else:
-        for i in range(len(head)):
-            if not nx.has_path(P, head[i], tail[i]):
-                return{'p': 0}
+        # Check all pairs with one connected components pass
+        if not QNET.pairs_connected(P, head, tail).all():
+            return{'p': 0}
     return {'p': 1}
 
+
+path_exist.default = {'p': 0}
+
+
+
+def _result_fields(result):
+    # Field names and values of a protocol result, which may be a cost vector, a tuple of costs or a single cost
+    if isinstance(result, dict):
+        return list(result.items())
+    if isinstance(result, (tuple, list)):
+        return [(f"cost_{i}", value) for i, value in enumerate(result)]
+    return [("cost", result)]
+
+
+# Arguments of batch_protocol shared by every task of a worker process, set once per worker by _init_batch_worker
+_batch_worker_args = None
+
+
+def _init_batch_worker(protocol, Q, protocol_kwargs):
+    global _batch_worker_args
+    _batch_worker_args = (protocol, Q, protocol_kwargs)
+
+
+def _batch_worker(pair):
+    protocol, Q, protocol_kwargs = _batch_worker_args
+    return protocol(Q, pair[0], pair[1], **protocol_kwargs)
+
+
+def batch_protocol(protocol, Q, heads, tails, protocol_kwargs=None, processes=None, pool='thread', default=None):
+    """
+    Evaluate a protocol for many head and tail pairs of a graph at once.
+
+    Setup shared by the pairs is done once: connectivity of all pairs is found with one connected components pass,
+    and the protocols use the cached compiled graph of Q (see Qnet.compiled). path_exist and best_costs are evaluated
+    for all pairs together, with best_costs using one shortest path tree per distinct head (see best_cost_matrix).
+
+    :param protocol: Protocol function, called as protocol(Q, head, tail, **protocol_kwargs)
+    :param Q: Qnet Graph
+    :param heads: List of head nodes (or names)
+    :param tails: List of tail nodes (or names), the same length as heads
+    :param dict, optional, protocol_kwargs: Keyword arguments of the protocol
+    :param int, optional, processes: Number of workers to evaluate the pairs with. If None, runs in this thread.
+    :param string, optional, pool: Either 'thread' or 'process'
+    :param optional, default: Result of pairs with no path between them. If None, protocol.default is used if the
+    protocol has one (as simple_purify, best_costs and path_exist do).
+    :return: Structured numpy array with a "head" and "tail" field holding the node names, and one field for each
+    cost of the protocol results. Pairs with no path between them get the default result, or nan if there is none.
+    """
+    assert pool in ('thread', 'process'), f"Unsupported pool: \'{pool}\'"
+    assert len(heads) == len(tails), "heads and tails must be the same length"
+    if protocol_kwargs is None:
+        protocol_kwargs = {}
+
+    heads = [Q.getNode(head) for head in heads]
+    tails = [Q.getNode(tail) for tail in tails]
+    assert None not in heads and None not in tails, "Head and tail nodes must be in Q"
+
+    # Check all pairs with one connected components pass
+    C = Q.compiled()
+    head_index = np.array([C.index[head] for head in heads], dtype=np.int64)
+    tail_index = np.array([C.index[tail] for tail in tails], dtype=np.int64)
+    connected = QNET.connected_pairs(len(C), C.edges, head_index, tail_index)
+
+    # Result of pairs with no path
+    if default is None:
+        default = getattr(protocol, 'default', None)
+
+    results = [default] * len(heads)
+    pairs = [i for i in range(len(heads)) if connected[i]]
+
+    if protocol is path_exist:
+        results = [{'p': int(c)} for c in connected]
+    elif protocol is best_costs and len(pairs) > 0:
+        # Single source shortest paths from each distinct head
+        sources, source_pos = np.unique(head_index[pairs], return_inverse=True)
+        targets, target_pos = np.unique(tail_index[pairs], return_inverse=True)
+        matrices = QNET.best_cost_matrix(Q, sources=[C.nodes[i] for i in sources],
+                                         targets=[C.nodes[i] for i in targets])
+        for n, i in enumerate(pairs):
+            results[i] = {'e': matrices['e'][source_pos[n], target_pos[n]],
+                          'f': matrices['f'][source_pos[n], target_pos[n]]}
+    elif processes is None or len(pairs) < 2:
+        for i in pairs:
+            results[i] = protocol(Q, heads[i], tails[i], **protocol_kwargs)
+    else:
+        tasks = [(heads[i], tails[i]) for i in pairs]
+        if pool == 'thread':
+            with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as executor:
+                values = list(executor.map(lambda pair: protocol(Q, pair[0], pair[1], **protocol_kwargs), tasks))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=_init_batch_worker,
+                                                        initargs=(protocol, Q, protocol_kwargs)) as executor:
+                values = list(executor.map(_batch_worker, tasks))
+        for i, value in zip(pairs, values):
+            results[i] = value
+
+    # Field names are taken from the first result that has them
+    fields = []
+    for result in results:
+        if result is not None:
+            fields = [name for name, value in _result_fields(result)]
+            break
+
+    dtype = [('head', object), ('tail', object)] + [(name, np.float64) for name in fields]
+    array = np.zeros(len(heads), dtype=dtype)
+    array['head'] = [head.name for head in heads]
+    array['tail'] = [tail.name for tail in tails]
+    for i, result in enumerate(results):
+        for name, value in ([] if result is None else _result_fields(result)):
+            array[name][i] = value
+        if result is None:
+            for name in fields:
+                array[name][i] = np.nan
+    return array
@@ -6,6 +6,9 @@ from Channel import *
 from Generators import *
 from SimFunctions import *
 from Costs import *
+from Connectivity import *
+from Compiled import *
+from Temporal import *
 
 def info():
     print('QNET (February 2019) - by Hudson Leone, Maria Kieferova, & Peter Rohde')
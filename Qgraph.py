@@ -6,6 +6,8 @@ Created on Tue Mar 24 17:22:47 2020
 """
 
 import networkx as nx
+import numpy as np
+import scipy.spatial
 import QNET
 from typing import Callable
 
@@ -121,6 +123,32 @@ class Qnet(nx.Graph):
         self.memory_vector = memory_vector
         self.memory_ranges = memory_ranges
         self.memory_conversions = memory_conversions
+
+        # Dictionary between node names and Qnodes. Kept in sync by the node and edge methods below so that getNode
+        # is a constant time lookup.
+        self._name_index = {}
+
+        # Version counter of the Qnet, incremented whenever its structure or costs change (See touch).
+        # The compiled snapshot of the Qnet is cached until the version changes. _stale_edges holds the edges whose
+        # costs changed since then, or None if the whole snapshot must be rebuilt. Changes made by hand to the cost
+        # dictionaries of the Qnet touch it (See CostDict), which forces a full rebuild.
+        self._version = 0
+        self._compiled = None
+        self._compiled_version = None
+        self._stale_edges = None
+
+        # Callables notified of every change to the Qnet (See subscribe)
+        self._listeners = []
+
+        # Minimum altitude angle (in degrees) at which satellites can see the ground, or None to keep every satellite
+        # channel regardless of visibility (See update)
+        self.min_elevation = None
+        # Registry of the potential channels between each satellite and the ground, as a dictionary between
+        # satellites and a dictionary between nodes and the costs of their channel. Channels out of sight are
+        # removed from the graph by update, and added back from the registry once visible.
+        self._sat_channels = {}
+        # Cached spatial index of the ground nodes in the registry (See _ground_index)
+        self._ground_index = None
         super().__init__(incoming_graph_data, **attr)
 
     def __str__(self):
@@ -154,6 +182,255 @@ class Qnet(nx.Graph):
 
         return (f"-- Default cost vector --\n{self.cost_vector}\n-- Qnodes --\n{qnodes}-- Qchans --\n{qchans}")
 
+    # The following NetworkX methods are extended to keep the name index of the Qnet consistent with its nodes, and
+    # to increment the version of the Qnet. NetworkX functions that build new graphs (nx.compose, Graph.copy, etc.)
+    # go through add_nodes_from and add_edges_from, so the index is rebuilt for them as well.
+
+    def _index_node(self, node):
+        if isinstance(node, QNET.Qnode):
+            self._name_index[node.name] = node
+            node.costs._own(self)
+
+    def _unindex_node(self, node):
+        if isinstance(node, QNET.Qnode) and self._name_index.get(node.name) is node:
+            del self._name_index[node.name]
+            node.costs._disown(self)
+
+    def _own_edges(self, edges):
+        # Make the Qnet see the changes made by hand to the cost dictionaries of edges (See CostDict)
+        for u, v in edges:
+            edge_data = self._adj[u][v]
+            if isinstance(edge_data, QNET.CostDict):
+                edge_data._own(self)
+
+    def __getstate__(self):
+        # Listeners belong to this Qnet, so they aren't copied or pickled with it
+        state = self.__dict__.copy()
+        state['_listeners'] = []
+        return state
+
+    def __setstate__(self, state):
+        # Copied and unpickled cost dictionaries aren't held by any Qnet, so take them over
+        self.__dict__.update(state)
+        for node in self._name_index.values():
+            node.costs._own(self)
+        self._own_edges(self.edges())
+
+    def add_node(self, node_for_adding, **attr):
+        super().add_node(node_for_adding, **attr)
+        self._index_node(node_for_adding)
+        self._changed('add_nodes', [node_for_adding])
+
+    def add_nodes_from(self, nodes_for_adding, **attr):
+        nodes_for_adding = list(nodes_for_adding)
+        super().add_nodes_from(nodes_for_adding, **attr)
+        added = []
+        for n in nodes_for_adding:
+            # Nodes may be given as (node, attribute_dict) tuples
+            if isinstance(n, tuple) and len(n) == 2 and isinstance(n[1], dict):
+                n = n[0]
+            self._index_node(n)
+            added.append(n)
+        self._changed('add_nodes', added)
+
+    def add_edge(self, u_of_edge, v_of_edge, **attr):
+        # New edge dictionaries are filled before the Qnet takes them over, so this isn't reported as an edit by hand
+        super().add_edge(u_of_edge, v_of_edge, **attr)
+        self._index_node(u_of_edge)
+        self._index_node(v_of_edge)
+        self._own_edges([(u_of_edge, v_of_edge)])
+        self._changed('add_edges', [(u_of_edge, v_of_edge)])
+
+    def add_edges_from(self, ebunch_to_add, **attr):
+        ebunch_to_add = list(ebunch_to_add)
+        super().add_edges_from(ebunch_to_add, **attr)
+        for edge in ebunch_to_add:
+            self._index_node(edge[0])
+            self._index_node(edge[1])
+        self._own_edges([(edge[0], edge[1]) for edge in ebunch_to_add])
+        self._changed('add_edges', [(edge[0], edge[1]) for edge in ebunch_to_add])
+
+    def remove_edge(self, u, v):
+        super().remove_edge(u, v)
+        self._changed('remove_edges', [(u, v)])
+
+    def remove_edges_from(self, ebunch):
+        ebunch = list(ebunch)
+        super().remove_edges_from(ebunch)
+        self._changed('remove_edges', [(edge[0], edge[1]) for edge in ebunch])
+
+    def remove_node(self, n):
+        super().remove_node(n)
+        self._unindex_node(n)
+        self._unregister_sat_channels([n])
+        self._changed('remove_nodes', [n])
+
+    def remove_nodes_from(self, nodes):
+        nodes = list(nodes)
+        super().remove_nodes_from(nodes)
+        for n in nodes:
+            self._unindex_node(n)
+        self._unregister_sat_channels(nodes)
+        self._changed('remove_nodes', nodes)
+
+    def clear(self):
+        super().clear()
+        self._name_index = {}
+        self._sat_channels = {}
+        self._ground_index = None
+        self.touch()
+
+    def clear_edges(self):
+        super().clear_edges()
+        self.touch()
+
+    def _rebuild_index(self):
+        """
+        Rebuild the name index from scratch. Needed whenever node names are changed in place.
+        """
+        self._name_index = {}
+        for node in self.nodes():
+            self._index_node(node)
+
+    @property
+    def version(self):
+        """
+        Version counter of the Qnet. It changes whenever the structure or costs of the Qnet change.
+
+        Views (see subgraph_view) share the version of the graph they filter.
+        """
+        if hasattr(self, '_graph'):
+            return self._graph.version
+        return self._version
+
+    def edge_attr_dict_factory(self):
+        # Edge dictionaries are CostDicts, so that changes made to them by hand are seen by the caches (See version)
+        return QNET.CostDict()
+
+    def touch(self, edge=None):
+        """
+        Marks the Qnet as changed, which invalidates its cached compiled snapshot.
+
+        This is done automatically by the Qnet methods and by changes made by hand to the costs of a Qnode or edge
+        dictionary (See CostDict). It only needs to be called directly after changing costs without reporting the
+        edit, as update_cost_vector does.
+
+        Parameters
+        ----------
+        edge: (Qnode, Qnode), optional
+            If given, only the costs of this edge have changed, so the cached snapshot can be refreshed instead of
+            rebuilt. (The default is None, which marks the whole Qnet as changed)
+
+        Returns
+        -------
+        None
+        """
+        if edge is None:
+            self._changed(None, None)
+        else:
+            self._changed('edges', [edge])
+
+    def _changed(self, change, items):
+        # Record a change to the Qnet and notify the listeners. change is one of 'edges' (edge costs changed),
+        # 'add_edges', 'remove_edges', 'add_nodes', 'remove_nodes', or None for any other change.
+        self._version += 1
+        if change != 'edges':
+            self._stale_edges = None
+        elif self._stale_edges is not None:
+            self._stale_edges.update(items)
+        for listener in list(self._listeners):
+            listener(change, items)
+
+    def subscribe(self, listener):
+        """
+        Registers a callable to be notified of every change to the Qnet.
+
+        The listener is called as listener(change, items) after each change, where change is one of:
+            + 'edges': the costs of the edges in items have changed (i.e. by Qnet.update)
+            + 'add_edges', 'remove_edges': the edges in items were added or removed (i.e. by add_qchan)
+            + 'add_nodes', 'remove_nodes': the Qnodes in items were added or removed (i.e. by remove_qnode)
+            + None: anything else may have changed, and items is None
+
+        Listeners are not copied with the Qnet.
+
+        Parameters
+        ----------
+        listener: function
+            Function of (change, items)
+
+        Returns
+        -------
+        None
+        """
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        """
+        Stops notifying a listener registered with subscribe
+        """
+        self._listeners.remove(listener)
+
+    def compiled(self):
+        """
+        Returns the cached compiled snapshot of the Qnet (see compile), compiling it again if the Qnet has changed.
+
+        If only edge costs have changed since the last compilation, the new snapshot shares the structure of the old
+        one and only the cost arrays are refreshed.
+
+        Returns
+        -------
+        CompiledQnet
+        """
+        version = self.version
+        if self._compiled is not None and self._compiled_version == version:
+            return self._compiled
+
+        if self._compiled is not None and self._stale_edges is not None and not hasattr(self, '_graph'):
+            self._compiled = self._compiled.refresh_edges(self._stale_edges)
+        else:
+            self._compiled = self.compile()
+        self._compiled_version = version
+        self._stale_edges = set()
+        return self._compiled
+
+    def _copy_settings(self, G):
+        # Graphs made by NetworkX are initialized with the default costs, so copy the costs of the Qnet over
+        for attr in ('cost_vector', 'cost_ranges', 'conversions', 'memory_vector', 'memory_ranges',
+                     'memory_conversions', 'min_elevation'):
+            setattr(G, attr, getattr(self, attr))
+        return G
+
+    def copy(self, as_view=False):
+        """
+        Returns a copy of the Qnet that shares its Qnodes.
+
+        Unlike copy.deepcopy, the Qnodes are not copied, only the graph structure and the edge cost dictionaries.
+        This makes it suitable for protocols that remove edges or nodes from a graph, but don't change Qnodes.
+
+        See NetworkX Documentation for Graph.copy
+        """
+        return self._copy_settings(super().copy(as_view))
+
+    def subgraph_view(self, filter_node=nx.classes.filters.no_filter, filter_edge=nx.classes.filters.no_filter):
+        """
+        Returns a read-only view of the Qnet that only shows the nodes and edges that pass the filters.
+
+        Nothing is copied. The view shares the Qnodes and edge dictionaries of the Qnet, and getNode works as
+        usual on the view.
+
+        Parameters
+        ----------
+        filter_node: function, optional
+            Function that takes a Qnode and returns True if it should be in the view
+        filter_edge: function, optional
+            Function that takes two Qnodes and returns True if the edge between them should be in the view
+
+        Returns
+        -------
+        Qnet
+        """
+        return self._copy_settings(nx.subgraph_view(self, filter_node=filter_node, filter_edge=filter_edge))
+
     def add_qnode(self, name=None, qnode_type=None, coords=None, **kwargs):
         """
         Initialize a qnode of some type and add it to the graph
@@ -188,6 +465,8 @@ class Qnet(nx.Graph):
         old_node = self.getNode(name)
         if old_node is not None:
             old_node.update(self, name=name, coords=coords, **kwargs)
+            # The costs of the existing node may have changed
+            self.touch()
         # Else, add new node
         else:
             # If qnode_type is none, initialize a node of the default type
@@ -301,6 +580,28 @@ class Qnet(nx.Graph):
         # Pass it through make_cost_vector to ensure that
         cost_vector = QNET.make_cost_vector(self, **kwargs)
         self.add_edge(u, v, **cost_vector)
+        self._register_sat_channel(u, v)
+
+    def _register_sat_channel(self, u, v):
+        # Record a channel between a satellite and a ground node as a potential channel (See update)
+        if isinstance(v, QNET.Satellite):
+            u, v = v, u
+        if not isinstance(u, QNET.Satellite) or isinstance(v, QNET.Satellite):
+            return
+        if self._ground_index is not None and v not in self._ground_index['index']:
+            self._ground_index = None
+        self._sat_channels.setdefault(u, {})[v] = self.edges[u, v]
+
+    def _unregister_sat_channels(self, nodes):
+        # Forget the potential channels of removed nodes
+        if len(self._sat_channels) == 0:
+            return
+        for node in nodes:
+            if node in self._sat_channels:
+                del self._sat_channels[node]
+            for channels in self._sat_channels.values():
+                channels.pop(node, None)
+        self._ground_index = None
 
     def add_qchans_from(self, cbunch):
         """
@@ -379,32 +680,49 @@ class Qnet(nx.Graph):
 
         Warnings
         --------
-        As node names in Qnet are expected to be unique, this function simply returns the first instance of a node that
-        matches the name given. In theory, this shouldn't be a problem regardless since the add_qnode method handles
+        As node names in Qnet are expected to be unique, this function simply returns the node most recently indexed
+        under the given name. In theory, this shouldn't be a problem regardless since the add_qnode method handles
         a duplicate name by overwriting the existing node.
 
+        Node names should not be changed in place. Use updateName (or _rebuild_index) so the name index stays valid.
+
         """
         if isinstance(node_name, QNET.Qnode):
-            for node in self.nodes():
-                if node.name == node_name.name:
-                    return node
-        for node in self.nodes():
-            if node.name == node_name:
-                return node
+            node_name = node_name.name
+        try:
+            node = self._name_index.get(node_name)
+        except TypeError:
+            # Unhashable names can't belong to any node
+            return None
+
+        # Graph views (i.e. nx.subgraph_view) share the nodes of the graph they filter, so defer to its index
+        if node is None and hasattr(self, '_graph'):
+            node = self._graph.getNode(node_name)
+
+        if node is not None and node in self:
+            return node
         return None
 
-    def update(self, dt):
+    def update(self, dt, incremental=True):
         """
         Updates all time dependent elements in the Qnet by a given time increment
 
         Currently, this function:
             + Updates Satellite positions
-            + Updates Satellite channel costs by performing the Node method "airCost"
+            + If min_elevation is set, removes the channels of satellites that are out of sight of the ground, and
+              adds back the channels that came into sight (See _visible_channels)
+            + Updates Satellite channel costs from the lines of sight given by the Node method "airGeometry". The costs
+              of all channels are calculated together with "air_costs"
 
         Parameters
         ----------
         dt : float
             Size of time increment
+        incremental : bool, optional
+            If True, the costs of existing satellite channels are rewritten in place. Any other costs on the channel
+            are kept. If False, satellite channels are removed and added again with add_qchan, which resets all other
+            costs of the channel to their defaults.
+            (The default is True)
         Returns
         -------
         None.
@@ -417,30 +735,242 @@ class Qnet(nx.Graph):
                 # Update satellite position:
                 node.posUpdate(dt)
 
-        # Update satellite channels
+        # Get satellite channels as (satellite, node, edge data)
+        if self.min_elevation is not None:
+            channels, geometry = self._visible_channels()
+        else:
+            channels = []
+            for node in self.nodes:
+                if isinstance(node, QNET.Satellite):
+                    # Get neighboring channels:
+                    for edge in self.edges(node, data=True):
+                        if isinstance(edge[0], QNET.Satellite):
+                            channels.append(edge)
+                        else:
+                            channels.append((edge[1], edge[0], edge[2]))
+            # Get the line of sight of each channel
+            geometry = [s.airGeometry(n) for s, n, d in channels]
+
+        if len(channels) == 0:
+            return
+
+        # Calculate all new costs in one call
+        geometry = np.array(geometry, dtype=float)
+        new_e, new_f = QNET.air_costs(geometry[:, 0], geometry[:, 1])
+
+        # Update channels:
+        for i in range(len(channels)):
+            s, n, d = channels[i]
+            if incremental is True:
+                QNET.update_cost_vector(self, d, e=new_e[i], f=new_f[i])
+                self.touch((s, n))
+            else:
+                self.remove_edge(s, n)
+                self.add_qchan(edge=[s.name, n.name], e=new_e[i], f=new_f[i])
+
+    def _ground_positions(self):
+        # Spatial index of the ground nodes in the registry of satellite channels, as Cartesian coordinates (for
+        # Cartesian satellites) and ECEF positions (for geodesic satellites). Cached until the registry changes.
+        if self._ground_index is None:
+            nodes = []
+            index = {}
+            for channels in self._sat_channels.values():
+                for node in channels:
+                    if node not in index:
+                        index[node] = len(nodes)
+                        nodes.append(node)
+            coords = np.array([list(node.coords[:3]) + [0] * (3 - len(node.coords)) for node in nodes],
+                              dtype=float).reshape(-1, 3)
+            self._ground_index = {'nodes': nodes, 'index': index, 'coords': coords,
+                                  'cartesian': scipy.spatial.cKDTree(coords),
+                                  'ecef': scipy.spatial.cKDTree(QNET.ecef(coords[:, 0], coords[:, 1]))}
+        return self._ground_index
+
+    def _visible_channels(self):
+        """
+        Find the satellite channels that are in sight of the ground, and bring the channels of the graph in line.
+
+        Ground nodes are looked up in a KD-tree (scipy.spatial.cKDTree) of their positions, so that only the ground
+        nodes within the footprint of each satellite are considered, rather than every potential channel. Only the
+        channels in the registry of satellite channels (recorded by add_qchan and update) are considered. Their lines
+        of sight are then checked against min_elevation. Channels out of sight are removed from the graph, and those
+        in sight that aren't in the graph are added back with the costs they were registered with.
+
+        Channels between satellites are always kept.
+
+        Returns
+        -------
+        (list, list)
+            Satellite channels as (satellite, node, edge data) and the line of sight of each (See airGeometry)
+        """
+        satellites = [node for node in self.nodes if isinstance(node, QNET.Satellite)]
+
+        # Register the channels in the graph, and keep the channels between satellites as they are
+        channels = []
+        geometry = []
+        for s in satellites:
+            for u, v, d in self.edges(s, data=True):
+                if isinstance(v, QNET.Satellite):
+                    if u is s:
+                        channels.append((u, v, d))
+                        geometry.append(u.airGeometry(v))
+                else:
+                    self._register_sat_channel(u, v)
+        satellites = [s for s in satellites if len(self._sat_channels.get(s, {})) > 0]
+        if len(satellites) == 0:
+            return channels, geometry
+        ground = self._ground_positions()
+
+        # Ground nodes within the footprint of each satellite
+        # Margin of 50 km for the difference between the spherical Earth and the WGS84 ellipsoid
+        margin = 50
+        candidates = {}
+        for cartesian in (True, False):
+            group = [s for s in satellites if s.cartesian is cartesian]
+            if len(group) == 0:
+                continue
+            coords = np.array([s.coords[:3] for s in group], dtype=float)
+            if cartesian:
+                # Above a flat ground, the line of sight must be shorter than the height over the lowest ground node
+                # divided by sin(min_elevation)
+                sin = np.sin(np.radians(self.min_elevation))
+                height = coords[:, 2] - ground['coords'][:, 2].min()
+                radius = np.where(sin > 0, height / max(sin, 1e-300), np.inf)
+                positions, tree = coords, ground['cartesian']
+            else:
+                # On a spherical Earth, with the margin above
+                radius = QNET.footprint_radius(coords[:, 2], self.min_elevation) + margin
+                positions, tree = QNET.ecef(coords[:, 0], coords[:, 1], coords[:, 2]), ground['ecef']
+            for s, position, r in zip(group, positions, radius):
+                if np.isfinite(r):
+                    candidates[s] = tree.query_ball_point(position, r)
+                else:
+                    candidates[s] = range(len(ground['nodes']))
+
+        # Check the lines of sight of the registered channels near each satellite
+        for s in satellites:
+            registered = self._sat_channels[s]
+            visible = set()
+            for i in candidates[s]:
+                n = ground['nodes'][i]
+                if n not in registered:
+                    continue
+                if s.cartesian and s.coords[2] <= n.coords[2]:
+                    # Ground node at or above a Cartesian satellite
+                    continue
+                theta, dist = s.airGeometry(n)
+                if np.degrees(theta) < self.min_elevation:
+                    continue
+                visible.add(n)
+                if not self.has_edge(s, n):
+                    self.add_edge(s, n, **registered[n])
+                    registered[n] = self.edges[s, n]
+                channels.append((s, n, self.edges[s, n]))
+                geometry.append((theta, dist))
+
+            # Remove the channels out of sight. Their costs are kept in the registry.
+            hidden = [(s, n) for n in self[s] if n in registered and n not in visible]
+            if len(hidden) > 0:
+                self.remove_edges_from(hidden)
+
+        return channels, geometry
+
+    def compile(self):
+        """
+        Compiles the Qnet into an immutable, integer-indexed snapshot with contiguous cost arrays.
+
+        For details, see the documentation for the CompiledQnet class
+
+        Returns
+        -------
+        CompiledQnet
+        """
+        return QNET.CompiledQnet(self)
+
+    def snapshot(self):
+        """
+        Records the time dependent state of the Qnet so it can be restored later with rollback.
+
+        Only the state changed by Qnet.update is recorded, that is the state of each Satellite (see Satellite.getState)
+        and the costs of each satellite channel. This is much cheaper than taking a deepcopy of the graph before a
+        simulation.
+
+        Returns
+        -------
+        dict
+            Snapshot of the Qnet
+        """
+        satellites = {}
+        channels = {}
+        for node in self.nodes:
+            if isinstance(node, QNET.Satellite):
+                satellites[node] = node.getState()
+                for edge in self.edges(node, data=True):
+                    channels[(edge[0], edge[1])] = dict(edge[2])
+        return {'satellites': satellites, 'channels': channels}
+
+    def rollback(self, snapshot):
+        """
+        Restores the time dependent state of the Qnet from the output of snapshot.
+
+        Satellite channels are restored to their recorded costs. Channels that were added since the snapshot are
+        removed and channels that were removed are added back.
+
+        Parameters
+        ----------
+        snapshot : dict
+            Output of Qnet.snapshot
+
+        Returns
+        -------
+        None.
+        """
+        channels = snapshot['channels']
+
+        for node, state in snapshot['satellites'].items():
+            node.setState(state)
+
+        # Remove satellite channels that weren't recorded
+        new_channels = []
+        for node in snapshot['satellites']:
+            if node in self:
+                for edge in self.edges(node):
+                    if edge not in channels and (edge[1], edge[0]) not in channels:
+                        new_channels.append(edge)
+        self.remove_edges_from(new_channels)
+
+        # Restore recorded channels. Existing edge dictionaries are updated in place
+        for (u, v), costs in channels.items():
+            if u not in self or v not in self:
+                continue
+            edge_data = self.get_edge_data(u, v)
+            if edge_data is None:
+                self.add_edge(u, v, **costs)
+            else:
+                # Restore without counting an edit by hand, so that only this edge is refreshed
+                dict.clear(edge_data)
+                dict.update(edge_data, costs)
+                self.touch((u, v))
+
+    def cacheEphemeris(self, tMax, dt):
+        """
+        Precomputes the ephemeris of every Satellite initialised with TLEs over the time grid getTimeArr(tMax, dt)
+
+        For details, see the documentation for the Satellite method "cacheEphemeris"
+
+        Parameters
+        ----------
+        tMax : float
+            Timespan of the ephemeris
+        dt : float
+            Time increment of the ephemeris
+        Returns
+        -------
+        None.
+        """
         for node in self.nodes:
             if isinstance(node, QNET.Satellite):
-                # Get neighboring channels:           
-                edges = self.edges(node)
-                # Update channels:
-                for edge in edges:
-                    if isinstance(edge[0], QNET.Satellite):
-                        s = edge[0]
-                        n = edge[1]
-                    else:
-                        n = edge[0]
-                        s = edge[1]
-
-                    # newCost = [e, p]
-                    newCost = s.airCost(n)
-
-                    # Unpack newCost
-                    new_e = newCost[0]
-                    new_p = newCost[1]
-
-                    # Update edge
-                    self.remove_edge(s, n)
-                    self.add_qchan(edge=[s.name, n.name], e=new_e, p=new_p)
+                node.cacheEphemeris(tMax, dt)
 
     def updateName(self, n):
         """
@@ -460,3 +990,5 @@ class Qnet(nx.Graph):
         """
         for node in self.nodes:
             node.name = str(n)+node.name
+        self._rebuild_index()
+        self.touch()
@@ -7,7 +7,6 @@ Created on Fri Feb 28 17:25:13 2020
 
 import networkx as nx
 import QNET
-import copy
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import art3d
@@ -30,9 +29,14 @@ def getTimeArr(tMax, dt):
     return np.arange(0, tMax, dt)
 
 
-def sim_all_simple(G, source, target, tMax, dt, cost_type=None):
+def sim_all_simple(G, source, target, tMax, dt, cost_type=None, k=None, cutoff=None):
     """
     Get the cost arrays for all simple paths over time
+
+    The number of simple paths grows exponentially with the size of G, so on anything larger than a small graph the
+    paths should be limited with k or cutoff. The paths are then the k best at the start of the simulation, found
+    with QNET.k_best_paths. (See sim_k_best_paths for the k best paths at each time step)
+
     :param G: Qnet Graph
     :type G: Qnet()
     :param source: Qnode
@@ -42,82 +46,231 @@ def sim_all_simple(G, source, target, tMax, dt, cost_type=None):
     :param dt: Time interval
     :type dt: float
     :param cost_type: string, optional
+    :param k: Maximum number of paths, ranked by cost_type (or the first cost type of G if cost_type is None)
+    :type k: int, optional
+    :param cutoff: Worst acceptable value of the ranking cost at the start of the simulation
+    :type cutoff: float, optional
     :return: Dictionary of paths to a list of cost arrays over time
     """
-    C = copy.deepcopy(G)
-
     # get source and target from names
-    source = C.getNode(source)
-    target = C.getNode(target)
+    source = G.getNode(source)
+    target = G.getNode(target)
+
+    # Create a generator of simple paths, and unpack them into QNET paths
+    if k is None and cutoff is None:
+        simplePathGen = (QNET.Path(G, path) for path in nx.algorithms.simple_paths.all_simple_paths(G, source, target))
+    else:
+        rank_type = next(iter(G.conversions)) if cost_type is None else QNET.remove_prefix(cost_type, "add_")
+        simplePathGen = QNET.k_best_paths(G, source, target, rank_type, k, cutoff)
+    path_arr = list(simplePathGen)
+
+    # Additive costs of all paths at all time steps
+    add_costs = sim_path_costs(G, path_arr, tMax, dt, additive=True)
+    cost_types = list(G.conversions)
+
+    # Assign each path to its cost array
+    path_dict = {}
+    for j, path in enumerate(path_arr):
+        cost_arr = {}
+        for c, name in enumerate(cost_types):
+            cost_arr["add_" + name] = add_costs[j, :, c]
+            cost_arr[name] = G.conversions[name][1](add_costs[j, :, c])
+
+        if cost_type is None:
+            # Fetch all costs in cost vector
+            path_dict[path] = [{name: cost[step] for name, cost in cost_arr.items()}
+                               for step in range(add_costs.shape[1])]
+        else:
+            # Fetch specified cost
+            path_dict[path] = list(cost_arr[cost_type])
 
-    # Create a generator of all simple paths
-    simplePathGen = nx.algorithms.simple_paths.all_simple_paths(C, source, target)
+    return path_dict
+
+
+def sim_path_costs(G, paths, tMax, dt, additive=False):
+    """
+    Get the costs of many paths over time as one array
 
-    # Unpack paths from generator into array as QNET paths
-    path_arr = []
-    for path in simplePathGen:
-        path_arr.append(QNET.Path(C, path))
+    The edge and node costs of G are recorded at each time step, and the costs of all paths at all time steps are
+    then found with one sparse matrix product (see QNET.PathIncidence). Paths through edges that are removed during
+    the simulation get an infinite additive cost while they are missing.
 
-    # Assign each path to an empty cost array
-    path_dict = {path: [] for path in path_arr}
+    :param G: Qnet Graph
+    :type G: Qnet()
+    :param paths: List of paths as QNET.Path objects or lists of Qnodes
+    :param tMax: Timespan
+    :type tMax: float
+    :param dt: Time interval
+    :type dt: float
+    :param additive: Return the additive costs instead of converting them back
+    :type additive: bool, optional
+    :return: (n_paths, n_steps, n_costs) array, with costs in the order of G.conversions
+    """
+    # Record the time dependent state of G so it can be restored after the simulation
+    snapshot = G.snapshot()
+    # Propagate TLE satellites over the whole simulation at once
+    G.cacheEphemeris(tMax, dt)
 
-    # Initialize array size
+    incidence = QNET.PathIncidence(G.compiled(), paths)
+
+    # Record the costs of all nodes and edges at each time step
     size_arr = len(np.arange(0, tMax, dt))
-    i = 0
-    while i < size_arr:
-        j = 0
-        while j < len(path_arr):
-            # Get the cost of each path and append it to respective array
-            if cost_type is None:
-                # Fetch all costs in cost vector
-                cost = path_arr[j].cost_vector
-            else:
-                # Fetch specified cost
-                cost = path_arr[j].cost_vector[cost_type]
-            path_dict[path_arr[j]].append(cost)
-            j += 1
+    cost_arrays = []
+    try:
+        i = 0
+        while i < size_arr:
+            cost_arrays.append(incidence.cost_array(G.compiled()))
+            G.update(dt)
+            i += 1
+    finally:
+        G.rollback(snapshot)
 
-        C.update(dt)
-        i += 1
+    return incidence.evaluate(cost_arrays, additive=additive)
 
-    for path in path_arr:
-        for node in path.node_array:
-            if isinstance(node, QNET.Satellite):
-                if node.cartesian is False:
-                    node.setTime()
 
-    return path_dict
+def sim_k_best_paths(G, source, target, tMax, dt, cost_type, k=1, cutoff=None):
+    """
+    Generate the k best paths and their costs at each time step.
+
+    Time steps are simulated lazily, as they are taken from the generator. G is restored to its initial state once
+    the generator is exhausted or closed.
+
+    :param G: Qnet Graph
+    :type G: Qnet()
+    :param source: Qnode
+    :param target: Qnode
+    :param tMax: Timespan
+    :type tMax: float
+    :param dt: Time interval
+    :type dt: float
+    :param cost_type: Cost type to rank the paths by
+    :type cost_type: string
+    :param k: Number of paths at each time step
+    :type k: int, optional
+    :param cutoff: Worst acceptable value of cost_type
+    :type cutoff: float, optional
+    :return: Generator of lists of (Path, cost) pairs, from best to worst, for each time step
+    """
+    # Record the time dependent state of G so it can be restored after the simulation
+    snapshot = G.snapshot()
+    # Propagate TLE satellites over the whole simulation at once
+    G.cacheEphemeris(tMax, dt)
+
+    size_arr = len(np.arange(0, tMax, dt))
+    try:
+        i = 0
+        while i < size_arr:
+            yield [(path, path.cost_vector[cost_type])
+                   for path in QNET.k_best_paths(G, source, target, cost_type, k, cutoff)]
+            G.update(dt)
+            i += 1
+    finally:
+        G.rollback(snapshot)
+
+
+def sim_best_path(G, source, target, cost_type, tMax, dt):
+    """
+    Get the best path and its cost at each time step.
+
+    A QNET.ShortestPathTree from source is kept across time steps. After each update of G, only the part of the tree
+    affected by the satellite channels whose costs changed is repaired, rather than searching the whole graph again.
+    Each distinct best path is stored once, and referred to by its index at each time step.
+
+    :param G: Qnet Graph
+    :type G: Qnet()
+    :param source: Source node
+    :param target: Target node
+    :param cost_type: Cost type to optimize
+    :type cost_type: string
+    :param tMax: Timespan
+    :type tMax: float
+    :param dt: Time interval
+    :type dt: float
+    :return: Array of the best cost at each time step, array of the index of the best path at each time step (-1 if
+        there is no path), and the list of best paths
+    """
+    # Record the time dependent state of G so it can be restored after the simulation
+    snapshot = G.snapshot()
+    # Propagate TLE satellites over the whole simulation at once
+    G.cacheEphemeris(tMax, dt)
+
+    size_arr = len(np.arange(0, tMax, dt))
+    cost_arr = np.empty(size_arr, dtype=np.float64)
+    path_ids = np.full(size_arr, -1, dtype=np.int64)
+    paths = []
+    path_index = {}
+    try:
+        tree = QNET.ShortestPathTree(G, source, cost_type)
+        i = 0
+        while i < size_arr:
+            if i > 0:
+                G.update(dt)
+                tree.update()
+            cost_arr[i] = tree.cost(target)
+            path = tree.path(target)
+            if path is not None:
+                nodes = tuple(tree.C.to_qnodes(path))
+                if nodes not in path_index:
+                    path_index[nodes] = len(paths)
+                    paths.append(QNET.Path(G, list(nodes)))
+                path_ids[i] = path_index[nodes]
+            i += 1
+    finally:
+        G.rollback(snapshot)
+
+    return cost_arr, path_ids, paths
 
 
 def sim_protocol(G, source, target, protocol, tMax, dt):
     """
     Get the cost arrays of a simple protocol over time
+
+    The protocol is given G itself at each time step, so that it can use the compiled snapshot that G keeps up to date
+    (see Qnet.compiled). A protocol that removes nodes or edges from the graph it is given must be marked with
+    protocol.mutates_graph = True, and is then given a copy of the graph structure (see Qnet.copy) instead.
+
     :param G: Qnet Graph
     :type G: Qnet()
     :param source: Qnode
     :param target: Qnode
+    :param protocol: Function of (graph, source, target)
     :param tMax: Timespan
     :type tMax: float
     :param dt: Time interval
     :type dt: float
     :return: List of cost arrays for the protocol over time.
     """
-    C = copy.deepcopy(G)
-    u = C.getNode(source)
-    v = C.getNode(target)
+    mutates_graph = getattr(protocol, 'mutates_graph', False)
+
+    # Record the time dependent state of G so it can be restored after the simulation
+    snapshot = G.snapshot()
+    # Propagate TLE satellites over the whole simulation at once
+    G.cacheEphemeris(tMax, dt)
+    u = G.getNode(source)
+    v = G.getNode(target)
 
     # Initialize cost array
     cost_arr = []
     # Initialize size of array
     size_arr = len(np.arange(0, tMax, dt))
-    i = 0
-    while i < size_arr:
-        # Run protocol to get either scalar cost or cost bector
-        cost = protocol(C, u, v)
-        cost_arr.append(cost)
-        # Update graph
-        C.update(dt)
-        i += 1
+    try:
+        i = 0
+        while i < size_arr:
+            # Run protocol to get either scalar cost or cost bector. Changes to G would be carried on to the next
+            # time steps, and rollback doesn't restore them, so protocols that change their graph get a copy.
+            if mutates_graph:
+                cost = protocol(G.copy(), u, v)
+            else:
+                version = G.version
+                cost = protocol(G, u, v)
+                assert G.version == version, \
+                    "The protocol changed the graph. Protocols that do so must set protocol.mutates_graph = True"
+            cost_arr.append(cost)
+            # Update graph
+            G.update(dt)
+            i += 1
+    finally:
+        G.rollback(snapshot)
     return cost_arr
 
 def plot_cv(x, cva, label):
@@ -129,48 +282,19 @@ def plot_cv(x, cva, label):
 
 
 def sim_optimal_cost(G, source_name, target_name, cost_type, tMax, dt):
-    # TODO: Not working
     """
     Calculate the costs of the lowest cost path from "source" to "target" over time.
     :param G: Qnet Graph
     :param string source_name: Name of source node
     :param string target_name: Name of target node
-    :param string cost_type: The type of cost to optimise over. Choose from {'loss', 'fid'}
+    :param string cost_type: The type of cost to optimise over. Choose from {'e', 'f'}
     :param float tMax: Time period
     :param float dt: Time increment
     :return: Optimal loss array
     """
-    C = copy.deepcopy(G)
-
-    u = C.getNode(source_name)
-    v = C.getNode(target_name)
-
-    # Initialize arrays
-    cost_arr = []
-    size = len(np.arange(0, tMax, dt))
-
-    # Get optimal path cost and append it to costArr
-    i = 0
-    while i < size:
-        cost = QNET.best_path_cost(C, source_name, target_name, cost_type)
-        cost_arr.append(cost)
-        # Update network
-        C.update(dt)
-        i += 1
-
-    """ 
-    simplePathGen = nx.algorithms.simple_paths.all_simple_paths(C, u, v) 
-    pathArr = []
-    for path in simplePathGen:
-        pathArr.append(QNET.Path(C, path))
-    for path in pathArr:
-        for node in path.node_array:
-            if isinstance(node, QNET.Satellite):
-                if node.cartesian is False:
-                    node.setTime()
-    """
-
-    return cost_arr
+    # Shortest path tree is repaired between time steps (see sim_best_path)
+    cost_arr, path_ids, paths = sim_best_path(G, source_name, target_name, cost_type, tMax, dt)
+    return list(cost_arr)
 
 def posPlot(Q, u, v, tMax, dt):
     """
@@ -182,29 +306,31 @@ def posPlot(Q, u, v, tMax, dt):
     :param dt: Size of timestep
     :return: None
     """
-    C = copy.deepcopy(Q)
+    # Record the time dependent state of Q so it can be restored afterwards
+    snapshot = Q.snapshot()
+    # Propagate TLE satellites over the whole simulation at once
+    Q.cacheEphemeris(tMax, dt)
 
-    u = C.getNode(u)
-    v = C.getNode(v)
+    u = Q.getNode(u)
+    v = Q.getNode(v)
 
     posArr = []
     sizeArr = len(np.arange(0,tMax,dt))
 
-    i = 0
-    while i < sizeArr:
-        if isinstance(u, QNET.Satellite):
-            dist = u.distance(v)
-        elif isinstance(v, QNET.Satellite):
-            dist = v.distance(u)
-        else:
-            assert(False)
-        posArr.append(dist)
-        C.update(dt)
-        i += 1
-    if isinstance(u, QNET.Satellite):
-        u.setTime()
-    if isinstance(v, QNET.Satellite):
-        v.setTime()
+    try:
+        i = 0
+        while i < sizeArr:
+            if isinstance(u, QNET.Satellite):
+                dist = u.distance(v)
+            elif isinstance(v, QNET.Satellite):
+                dist = v.distance(u)
+            else:
+                assert(False)
+            posArr.append(dist)
+            Q.update(dt)
+            i += 1
+    finally:
+        Q.rollback(snapshot)
     
     timeArr = QNET.getTimeArr(tMax, dt)
     plt.plot(timeArr, posArr)
@@ -338,23 +464,27 @@ def satTrajectory(Q, u, tMax, dt):
         Each array element contains latitude, longitude of satellite at a given time.
 
     '''
-    C = copy.deepcopy(Q)
-    u = C.getNode(u)
+    # Record the time dependent state of Q so it can be restored afterwards
+    snapshot = Q.snapshot()
+    # Propagate TLE satellites over the whole simulation at once
+    Q.cacheEphemeris(tMax, dt)
+    u = Q.getNode(u)
     
     posArr = []
     sizeArr = len(np.arange(0,tMax,dt))
 
-    i = 0
-    while i < sizeArr:
-        if isinstance(u, QNET.Satellite):
-            pos = [u.coords[0], u.coords[1]]
-        else:
-            assert(False)
-        posArr.append(pos)
-        C.update(dt)
-        i += 1
-    if isinstance(u, QNET.Satellite):
-        u.setTime()
+    try:
+        i = 0
+        while i < sizeArr:
+            if isinstance(u, QNET.Satellite):
+                pos = [u.coords[0], u.coords[1]]
+            else:
+                assert(False)
+            posArr.append(pos)
+            Q.update(dt)
+            i += 1
+    finally:
+        Q.rollback(snapshot)
     return posArr
 
 
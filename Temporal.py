@@ -0,0 +1,515 @@
+"""
+Temporal.py contains the TemporalQnet class, an array-backed spatio-temporal extension of a Qnet graph.
+
+Rather than copying the graph once per layer as temporalGen does, the nodes and node costs of the graph are shared by
+every layer, and only the costs of the edges, which change as satellites move, are stored per layer. The layered graph
+is implicit: a state is a pair (node, layer), and the weighted adjacency of all states is assembled from the arrays
+when a shortest path is asked for.
+"""
+
+import heapq
+import numpy as np
+import scipy.sparse
+from scipy.sparse import csgraph
+import QNET
+
+
+def _edge_keys(nodes, C):
+    # Key of each edge of the snapshot C, from the indices of its Qnodes in nodes. Edges of Qnodes that aren't in
+    # nodes get the key -1.
+    if C.nodes is nodes or C.nodes == nodes:
+        indices = np.arange(len(nodes))
+    else:
+        index = {node: i for i, node in enumerate(nodes)}
+        indices = np.array([index.get(node, -1) for node in C.nodes], dtype=np.int64)
+    u, v = indices[C.edges[:, 0]], indices[C.edges[:, 1]]
+    lo, hi = np.minimum(u, v), np.maximum(u, v)
+    return np.where(lo < 0, -1, lo * len(nodes) + hi)
+
+
+def _edge_costs_in(nodes, edges, C, cost_types):
+    # Additive costs of the snapshot C at edges, an (M, 2) array of indices into nodes. Edges missing from C get an
+    # infinite cost.
+    if C.nodes == nodes and (C.edges is edges or np.array_equal(C.edges, edges)):
+        return {cost_type: C.edge_costs[cost_type] for cost_type in cost_types}
+
+    # Otherwise match the edges by their keys
+    keys = np.minimum(edges[:, 0], edges[:, 1]) * len(nodes) + np.maximum(edges[:, 0], edges[:, 1])
+    layer_keys = _edge_keys(nodes, C)
+    order = np.argsort(layer_keys)
+    position = np.minimum(np.searchsorted(layer_keys, keys, sorter=order), max(len(order) - 1, 0))
+    found = (layer_keys[order[position]] == keys) if len(order) > 0 else np.zeros(len(keys), dtype=bool)
+    costs = {}
+    for cost_type in cost_types:
+        costs[cost_type] = np.full(len(edges), np.inf)
+        costs[cost_type][found] = C.edge_costs[cost_type][order[position[found]]]
+    return costs
+
+
+def _memory_costs(Q, C):
+    # Memory nodes of C, and the additive cost of storing each node for one layer, converted in the same way as
+    # add_memory_qchan
+    memory = np.array([node.isMemory for node in C.nodes], dtype=bool)
+    memory_costs = {}
+    for cost_type in Q.conversions:
+        values = [node.memory.get("mem_" + cost_type, Q.cost_vector[cost_type]) for node in C.nodes]
+        memory_costs["add_" + cost_type] = Q.conversions[cost_type][0](np.array(values, dtype=np.float64))
+    return memory, memory_costs
+
+
+class TemporalQnet:
+    def __init__(self, Q, dt, n, startLayer=0, endLayer=None):
+        """
+        Build the temporal extension of a Qnet in one pass over its layers.
+
+        Q is stepped forward by dt for each layer, recording the costs of its edges, and is restored to its initial
+        state afterwards. Channels may be added or removed between layers (i.e. by the visibility check of
+        Qnet.update when Q.min_elevation is set), so the edges of the temporal graph are those of every layer.
+        Nodes with quantum memory (node.isMemory == True) are connected to themselves in the next layer for layers
+        between startLayer and endLayer, as in temporalGen.
+
+        Parameters
+        ----------
+        Q : Qnet()
+            The spatial graph
+        dt : float
+            Time step between layers
+        n : int
+            Number of layers
+        startLayer : int, optional
+            First layer connected in the temporal dimension. (The default is 0)
+        endLayer : int, optional
+            Last layer connected in the temporal dimension. (The default is None, which is n-1)
+
+        Attributes
+        ----------
+        C : CompiledQnet
+            Compiled graph of the first layer. Node indices are those of C in every layer.
+        edges : array
+            (M, 2) array of the node indices of the edges found in any layer
+        node_costs : dict [str, array]
+            Additive cost of each node, for each additive cost type
+        edge_costs : dict [str, array]
+            (n, M) array of the additive cost of each edge in each layer, for each additive cost type. Edges missing
+            from a layer have an infinite cost.
+        memory : array
+            Boolean array, True for the nodes with quantum memory
+        memory_costs : dict [str, array]
+            Additive cost of storing each node in memory for one layer, for each additive cost type
+        """
+        if endLayer is None:
+            endLayer = n - 1
+        assert (0 <= startLayer <= n-1), f"Out of range -- 0 <= startLayer <= n-1 "
+        assert (0 <= endLayer <= n-1), f"Out of range -- 0 <= endLayer <= n-1 "
+        assert (startLayer <= endLayer), f"startLayer <= endLayer <= n-1 "
+
+        self.G = Q
+        self.dt = dt
+        self.num_layers = n
+        self.startLayer = startLayer
+        self.endLayer = endLayer
+        self.conversions = Q.conversions
+
+        C = Q.compiled()
+        self.C = C
+        self.cost_types = ["add_" + cost_type for cost_type in Q.conversions]
+        self.node_costs = {cost_type: C.node_costs[cost_type] for cost_type in self.cost_types}
+
+        self.memory, self.memory_costs = _memory_costs(Q, C)
+
+        # Step through the layers, keeping the compiled graph of each
+        layers = []
+        snapshot = Q.snapshot()
+        Q.cacheEphemeris(n * dt, dt)
+        try:
+            for layer in range(n):
+                layers.append(Q.compiled())
+                if layer < n - 1:
+                    Q.update(dt)
+        finally:
+            Q.rollback(snapshot)
+
+        # Edges of every layer. Snapshots refreshed from the first one share its edge array.
+        self.edges = C.edges
+        if any(layer.edges is not C.edges for layer in layers):
+            keys = np.unique(np.concatenate([_edge_keys(C.nodes, layer) for layer in layers]))
+            keys = keys[keys >= 0]
+            self.edges = np.column_stack([keys // len(C), keys % len(C)])
+
+        # Record the edge costs of each layer
+        self.edge_costs = {cost_type: np.empty((n, len(self.edges))) for cost_type in self.cost_types}
+        for layer in range(n):
+            layer_costs = self.layer_edge_costs(layers[layer])
+            for cost_type in self.cost_types:
+                self.edge_costs[cost_type][layer] = layer_costs[cost_type]
+
+    def __len__(self):
+        return self.num_layers * len(self.C)
+
+    def __repr__(self):
+        return f"TemporalQnet({len(self.C)} nodes, {len(self.edges)} edges, {self.num_layers} layers)"
+
+    def layer_edge_costs(self, C):
+        """
+        Get the additive edge costs of a snapshot of the graph, in the order of edges. Edges missing from the snapshot
+        have an infinite cost, and edges of the snapshot that aren't in edges are left out.
+
+        Parameters
+        ----------
+        C : CompiledQnet
+            Snapshot of the graph (i.e. Q.compiled() after an update)
+
+        Returns
+        -------
+        dict [str, array]
+        """
+        return _edge_costs_in(self.C.nodes, self.edges, C, self.cost_types)
+
+    def state(self, node, layer):
+        """
+        Get the index of the state (node, layer). node may be a Qnode, a name or a node index.
+        """
+        if not isinstance(node, (int, np.integer)):
+            node = self.C.get_index(node)
+            assert node is not None, "Node is not in the graph"
+        assert 0 <= layer < self.num_layers, f"Out of range -- 0 <= layer <= {self.num_layers - 1}"
+        return layer * len(self.C) + node
+
+    def node_layer(self, state):
+        """
+        Get the (Qnode, layer) pair of a state index
+        """
+        layer, node = divmod(int(state), len(self.C))
+        return self.C.nodes[node], layer
+
+    def memory_weight(self, cost_type):
+        """
+        Weights of the memory edges of every node, from a layer to the next. Nodes without memory get inf.
+
+        The weight of storing node v is cost(v)/2 + cost(v)/2 + memory cost(v), as for any other edge.
+        """
+        weight = self.node_costs[cost_type] + self.memory_costs[cost_type]
+        return np.where(self.memory, weight, np.inf)
+
+    def weights(self, cost_type):
+        """
+        Get the weighted adjacency matrix of all states for an additive cost type.
+
+        Spatial edges connect states in the same layer in both directions. Memory edges only go forward in time,
+        from (v, layer) to (v, layer + 1) for startLayer <= layer < endLayer.
+
+        Parameters
+        ----------
+        cost_type: str
+            Additive cost type (i.e. 'add_e')
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+        """
+        assert cost_type in self.cost_types, f"Invalid cost type. \"{cost_type}\" not in {self.cost_types}"
+        num_nodes = len(self.C)
+        u, v = self.edges[:, 0], self.edges[:, 1]
+        node_cost = self.node_costs[cost_type]
+
+        # Spatial edges of every layer
+        offset = (np.arange(self.num_layers) * num_nodes)[:, None]
+        weight = node_cost[u] / 2 + node_cost[v] / 2 + self.edge_costs[cost_type]
+        rows = [(u + offset).ravel(), (v + offset).ravel()]
+        cols = [(v + offset).ravel(), (u + offset).ravel()]
+        data = [weight.ravel(), weight.ravel()]
+
+        # Memory edges
+        memory_weight = self.memory_weight(cost_type)
+        nodes = np.nonzero(np.isfinite(memory_weight))[0]
+        layers = np.arange(self.startLayer, self.endLayer)[:, None]
+        rows.append((layers * num_nodes + nodes).ravel())
+        cols.append(((layers + 1) * num_nodes + nodes).ravel())
+        data.append(np.broadcast_to(memory_weight[nodes], (len(layers), len(nodes))).ravel())
+
+        rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+        keep = np.isfinite(data)
+        size = len(self)
+        return scipy.sparse.csr_matrix((data[keep], (rows[keep], cols[keep])), shape=(size, size))
+
+    def shortest_path(self, source, target, cost_type, start=0, end=None):
+        """
+        Find the space-time path from source at layer start to target at any layer up to end that optimizes a cost.
+
+        Parameters
+        ----------
+        source: Union[str, Qnode]
+            Source node
+        target: Union[str, Qnode]
+            Target node
+        cost_type: str
+            Any valid cost type from the cost vector (i.e. 'e')
+        start: int, optional
+            Layer of the source. (The default is 0)
+        end: int, optional
+            Last layer the target can be reached in. (The default is None, which is the last layer)
+
+        Returns
+        -------
+        (list, float)
+            List of (Qnode, layer) pairs of the path and its cost. If no path exists, returns (None, cost) with the
+            cost of an infinite additive cost.
+        """
+        assert cost_type in self.conversions, \
+            f"Invalid cost type. \"{cost_type}\" not in {str([key for key in self.conversions])}"
+        if end is None:
+            end = self.num_layers - 1
+        add_cost_type = "add_" + cost_type
+        s = self.state(source, start)
+        target = self.C.get_index(target)
+        assert target is not None, "Target is not in the graph"
+
+        dist, pred = csgraph.dijkstra(self.weights(add_cost_type), directed=True, indices=s,
+                                      return_predecessors=True)
+        targets = np.array([self.state(target, layer) for layer in range(start, end + 1)])
+        t = targets[np.argmin(dist[targets])]
+        if not np.isfinite(dist[t]):
+            return None, self.conversions[cost_type][1](np.inf)
+
+        path = [t]
+        while path[-1] != s:
+            path.append(pred[path[-1]])
+        path = [self.node_layer(state) for state in path[::-1]]
+
+        # Compensate shortest path cost with 1/2 head cost and 1/2 tail cost
+        node_cost = self.node_costs[add_cost_type]
+        cost = dist[t] + node_cost[s % len(self.C)] / 2 + node_cost[target] / 2
+        return path, self.conversions[cost_type][1](cost)
+
+
+class LayerCosts:
+    def __init__(self, Q, dt, num_layers=None):
+        """
+        Edge costs of a Qnet at each time step, computed on demand.
+
+        Layer l is the state of Q after l updates of dt. Layers are computed by stepping Q forward in place, only as
+        far as the latest layer asked for, and are kept until released. Q is restored to its initial state by
+        close(). Each layer is given as the compiled graph of Q at that time, so channels that are added or removed
+        between layers (i.e. by the visibility check of Qnet.update when Q.min_elevation is set) are kept track of.
+
+        Parameters
+        ----------
+        Q : Qnet()
+            The spatial graph
+        dt : float
+            Time step between layers
+        num_layers : int, optional
+            Number of layers that may be asked for. If given, satellite ephemerides are cached for all of them.
+
+        Attributes
+        ----------
+        C : CompiledQnet
+            Compiled graph of the first layer. Node indices are those of C in every layer.
+        cost_types : list
+            Additive cost types of the edge costs
+        """
+        self.G = Q
+        self.dt = dt
+        self.C = Q.compiled()
+        self.cost_types = ["add_" + cost_type for cost_type in Q.conversions]
+        self._snapshot = Q.snapshot()
+        if num_layers is not None:
+            Q.cacheEphemeris(num_layers * dt, dt)
+        self._layer = 0
+        self._layers = {}
+
+    def __call__(self, layer):
+        """
+        Get the compiled graph of a layer. Its edge_costs are the edge costs of the layer.
+        """
+        if layer not in self._layers:
+            assert layer >= self._layer, f"Layer {layer} was already released"
+            while self._layer < layer:
+                self.G.update(self.dt)
+                self._layer += 1
+            C = self.G.compiled()
+            assert C.nodes == self.C.nodes, "Qnodes can't be added or removed between layers"
+            self._layers[layer] = C
+        return self._layers[layer]
+
+    def release(self, layer):
+        """
+        Free the costs of every layer up to and including layer
+        """
+        for stored in [stored for stored in self._layers if stored <= layer]:
+            del self._layers[stored]
+
+    def __len__(self):
+        # Number of layers currently held in memory
+        return len(self._layers)
+
+    def close(self):
+        """
+        Restore Q to its initial state
+        """
+        self.G.rollback(self._snapshot)
+        self._layers = {}
+
+
+def temporal_best_path(Q, source, target, cost_type, dt, num_layers, start=0, costs=None):
+    """
+    Find the best space-time path between two nodes, routing through quantum memory.
+
+    This is a time-dependent Dijkstra search over (node, layer) states, where layer l is Q after l updates of dt.
+    Spatial edges connect nodes within a layer. Nodes with quantum memory (node.isMemory == True) can also wait for
+    the next layer, at the cost of their memory costs (mem_e, mem_f). The layered graph is never built: the edge
+    costs and search labels of a layer are only made when the search first reaches it, and are freed once every
+    state left to search is in a later layer, so memory grows with the search frontier rather than with the number
+    of layers.
+
+    Parameters
+    ----------
+    Q : Qnet()
+        Qnet graph
+    source : Union[str, Qnode]
+        Source node
+    target : Union[str, Qnode]
+        Target node
+    cost_type : str
+        Any valid cost type from the cost vector (i.e. 'e')
+    dt : float
+        Time step between layers
+    num_layers : int
+        Number of layers in the time window. The target can be reached in any of them.
+    start : int, optional
+        Layer of the source. (The default is 0)
+    costs : LayerCosts, optional
+        Provider of the compiled graph of each layer. (The default is None, which steps Q forward with Qnet.update
+        and restores it afterwards)
+
+    Returns
+    -------
+    (list, float)
+        List of (Qnode, layer) pairs of the path and its cost. If no path exists, returns (None, cost) with the cost
+        of an infinite additive cost.
+
+    Examples
+    --------
+    A waits in memory until the satellite is in sight of both A and B, which it isn't at the first layer. The cost
+    agrees with TemporalQnet and with a search over the layers of temporalGen.
+    >>> Q = QNET.Qnet()
+    >>> Q.min_elevation = 45
+    >>> Q.add_qnode(name='A', qnode_type='Ground', coords=[0, 0, 0], isMemory=True, mem_e=0.99)
+    >>> Q.add_qnode(name='B', qnode_type='Ground', coords=[100, 0, 0])
+    >>> Q.add_qnode(name='S', qnode_type='Satellite', coords=[-1500, 0, 500], v_cart=[20, 0])
+    >>> Q.add_qchan(edge=['A', 'S'])
+    >>> Q.add_qchan(edge=['S', 'B'])
+    >>> Q.update(0)
+    >>> Q.number_of_edges()
+    0
+    >>> path, cost = temporal_best_path(Q, 'A', 'B', 'e', 20, 10)
+    >>> path
+    [(A, 0), (A, 1), (A, 2), (A, 3), (A, 4), (S, 4), (B, 4)]
+    >>> bool(np.isclose(cost, TemporalQnet(Q, 20, 10).shortest_path('A', 'B', 'e')[1]))
+    True
+    >>> import networkx as nx
+    >>> G = QNET.temporalGen(Q, 20, 10)
+    >>> head = G.getNode('0A')
+    >>> best = max(QNET.best_path_cost(G, head, tail, 'e') for tail in G.nodes
+    ...            if tail.name.endswith('B') and nx.has_path(G, head, tail))
+    >>> bool(np.isclose(cost, best))
+    True
+
+    Waiting in memory only adds costs when nothing moves, so on a graph without satellites the path stays in the
+    first layer and has the cost of best_path_cost
+    >>> R = QNET.Qnet()
+    >>> for name in 'ABC':
+    ...     R.add_qnode(name=name, qnode_type='Ground', isMemory=True, mem_e=0.9)
+    >>> R.add_qchan(edge=['A', 'B'], e=0.8)
+    >>> R.add_qchan(edge=['B', 'C'], e=0.7)
+    >>> path, cost = temporal_best_path(R, 'A', 'C', 'e', 1, 5)
+    >>> path, bool(np.isclose(cost, QNET.best_path_cost(R, 'A', 'C', 'e')))
+    ([(A, 0), (B, 0), (C, 0)], True)
+    """
+    conversions = Q.conversions
+    assert cost_type in conversions, f"Invalid cost type. \"{cost_type}\" not in {str([key for key in conversions])}"
+    assert 0 <= start < num_layers, f"Out of range -- 0 <= start <= {num_layers - 1}"
+    add_cost_type = "add_" + cost_type
+
+    own_costs = costs is None
+    if own_costs:
+        costs = LayerCosts(Q, dt, num_layers)
+    C = costs.C
+    s = C.get_index(source)
+    t = C.get_index(target)
+    assert s is not None and t is not None, "Source and target must be in Q"
+
+    node_cost = C.node_costs[add_cost_type]
+    memory, memory_costs = _memory_costs(Q, C)
+    memory_weight = node_cost + memory_costs[add_cost_type]
+
+    # Labels of the states reached so far, as dictionaries between layers and the distance, parent link and
+    # settlement of the nodes in that layer. A link is a (node, layer, parent link) tuple of a settled state, so a path
+    # is kept alive only as long as some state still refers to it.
+    # States only lead to the same or the next layer, and layers are searched in order of their lowest state on the
+    # heap, so a layer and its labels are released once the heap has no state in it or before it.
+    dist = {start: {s: 0.0}}
+    parents = {start: {s: None}}
+    done = {start: set()}
+    heap = [(0.0, start, s)]
+    on_heap = {start: 1}
+    lowest = start
+    found = None
+
+    try:
+        while len(heap) > 0:
+            d, layer, node = heapq.heappop(heap)
+            on_heap[layer] -= 1
+            while lowest < num_layers and on_heap.get(lowest, 0) == 0 and lowest < layer:
+                costs.release(lowest)
+                dist.pop(lowest, None)
+                parents.pop(lowest, None)
+                done.pop(lowest, None)
+                lowest += 1
+            layer_done = done.setdefault(layer, set())
+            if node in layer_done:
+                continue
+            layer_done.add(node)
+            link = (node, layer, parents[layer].pop(node))
+            if node == t:
+                found = (link, d)
+                break
+
+            # Spatial edges in this layer
+            layer_C = costs(layer)
+            edge_cost = layer_C.edge_costs[add_cost_type]
+            moves = []
+            for entry in range(layer_C.indptr[node], layer_C.indptr[node + 1]):
+                nbr = layer_C.indices[entry]
+                moves.append((nbr, layer,
+                              node_cost[node] / 2 + node_cost[nbr] / 2 + edge_cost[layer_C.edge_ids[entry]]))
+
+            # Waiting in memory for the next layer
+            if memory[node] and layer + 1 < num_layers:
+                moves.append((node, layer + 1, memory_weight[node]))
+
+            for nbr, nbr_layer, weight in moves:
+                new_d = d + weight
+                layer_dist = dist.setdefault(nbr_layer, {})
+                if np.isfinite(new_d) and new_d < layer_dist.get(nbr, np.inf):
+                    layer_dist[nbr] = new_d
+                    parents.setdefault(nbr_layer, {})[nbr] = link
+                    heapq.heappush(heap, (new_d, nbr_layer, nbr))
+                    on_heap[nbr_layer] = on_heap.get(nbr_layer, 0) + 1
+    finally:
+        if own_costs:
+            costs.close()
+
+    if found is None:
+        return None, conversions[cost_type][1](np.inf)
+
+    link, d = found
+    path = []
+    while link is not None:
+        node, layer, link = link
+        path.append((C.nodes[node], layer))
+    path = path[::-1]
+
+    # Compensate shortest path cost with 1/2 head cost and 1/2 tail cost
+    cost = d + node_cost[s] / 2 + node_cost[t] / 2
+    return path, conversions[cost_type][1](cost)